@@ -1,58 +1,110 @@
 import asyncio
-import time
-from typing import Any, Dict, Callable
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from fastapi import UploadFile, File
-from tenacity import stop_after_attempt, retry, wait_exponential
 
 from api_requests import APIRequest
+from cache import cache_mode, cached, make_key, stream_digest
 from config import Config
 from constant import AutoSupervision
+from metrics import (API_CALL_LATENCY, RULE_TASKS_IN_FLIGHT, RULE_TASKS_PENDING, CallbackCounter, Gauge,
+                     registry)
 from model import SuperViseGroup
-
-# 创建一个信号量来限制并发请求数
-MAX_CONCURRENT_REQUESTS = 5
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-
-
-# 创建一个简单的限流器
-class RateLimiter:
-    def __init__(self, calls_per_second):
-        self.calls_per_second = calls_per_second
-        self.last_call_time = 0
-
-    async def wait(self):
-        current_time = time.time()
-        time_since_last_call = current_time - self.last_call_time
-        if time_since_last_call < 1 / self.calls_per_second:
-            await asyncio.sleep(1 / self.calls_per_second - time_since_last_call)
-        self.last_call_time = time.time()
-
-
-rate_limiter = RateLimiter(1)  # 每秒最多1个请求
-
-
-# Retry decorator
-def retry_async(retries: int = 3, delay: float = 1.0):
-    def decorator(func: Callable):
-        async def wrapper(*args, **kwargs):
-            last_exception = None
-            for _ in range(retries):
+from rate_limiter import endpoint_name
+from scheduler import current_priority
+from similarity import find_similar, remember
+from speculation import run_dependent
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一时刻相同的请求只向上游发送一次，其余请求等待并共享结果
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]):
+        task = self.calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # 独立任务执行，发起者被取消时不影响其他等待者
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # 所有等待者都已取消时避免未读取异常的警告
+
+    def stats(self):
+        total = self.executed + self.coalesced
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.calls),
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
+
+
+single_flight = SingleFlight()
+
+registry.register(CallbackCounter('singleflight_executed_total', 'Calls executed by single-flight', (),
+                                  lambda: {(): single_flight.executed}))
+registry.register(CallbackCounter('singleflight_coalesced_total', 'Calls coalesced onto an in-flight call', (),
+                                  lambda: {(): single_flight.coalesced}))
+registry.register(Gauge('singleflight_in_flight', 'Distinct calls currently in flight', (),
+                        lambda: {(): len(single_flight.calls)}))
+
+
+async def gather_with_concurrency(limit: int, coroutines, stage: str = "default"):
+    """
+    并发执行协程，同时最多运行 limit 个，结果按传入顺序返回；
+    等待和运行中的数量按 stage 上报到 /metrics
+    """
+    semaphore_ = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        RULE_TASKS_PENDING.inc(stage=stage)
+        acquired = False
+        try:
+            async with semaphore_:
+                acquired = True
+                RULE_TASKS_PENDING.dec(stage=stage)
+                RULE_TASKS_IN_FLIGHT.inc(stage=stage)
                 try:
-                    return await func(*args, **kwargs)
-                except Exception as e:
-                    last_exception = e
-                    await asyncio.sleep(delay)
-            raise last_exception
+                    return await coroutine
+                finally:
+                    RULE_TASKS_IN_FLIGHT.dec(stage=stage)
+        finally:
+            # 等待期间被取消时也要扣减等待数
+            if not acquired:
+                RULE_TASKS_PENDING.dec(stage=stage)
 
-        return wrapper
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
 
-    return decorator
+
+def flight_key(url: str, data: Dict[str, Any]) -> str:
+    # 合并的调用按发起者的优先级排队，优先级不同的请求分开执行，高优先级请求不会排在低优先级调用之后
+    return f"{cache_mode.get().value}:{current_priority.get().value}:{make_key(url, data)}"
 
 
 async def api_request(url: str, data: Dict[str, Any]):
     if not data:
         return {"error": "No data provided"}
+    # 缓存模式不同的请求不能共享结果，耗时包含缓存、合并、限流和重试
+    with API_CALL_LATENCY.time(endpoint=endpoint_name(url)):
+        return await single_flight.do(flight_key(url, data), lambda: cached(url, data, lambda: _post(url, data)))
+
+
+async def _post(url: str, data: Dict[str, Any]):
     try:
         response = await APIRequest.post(url, data=data)
         return response
@@ -60,13 +112,24 @@ async def api_request(url: str, data: Dict[str, Any]):
         return {"error": str(e)}
 
 
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), digest: Optional[str] = None):
+    """
+    以 multipart 流式上传文件对象，不把文件读入内存；digest 为调用方已算好的 sha256
+    """
     if not file:
         return {"error": "No file provided"}
     try:
-        file_content = await file.read()
-        files = {'file': file_content}
-        return await APIRequest.post(Config.UPLOAD_FILE_URL, files=files)
+        # httpx 每次发送前回到文件开头，重试时可复用同一个文件对象
+        files = {'file': (file.filename, file.file)}
+        # 相同内容的文件解析结果相同，按文件内容哈希缓存
+        if digest is None:
+            digest = await asyncio.to_thread(stream_digest, file.file)
+        payload = {"sha256": digest}
+        with API_CALL_LATENCY.time(endpoint=endpoint_name(Config.UPLOAD_FILE_URL)):
+            return await single_flight.do(
+                flight_key(Config.UPLOAD_FILE_URL, payload),
+                lambda: cached(Config.UPLOAD_FILE_URL, payload,
+                               lambda: APIRequest.post(Config.UPLOAD_FILE_URL, files=files)))
     except Exception as e:
         return {"error": str(e)}
 
@@ -79,8 +142,6 @@ async def split_atomic_rules(rule):
     return await api_request(Config.SPLIT_ATOMIC_RULES_URL, {"rule": rule})
 
 
-# 重试装饰器，最多重试3次，每次等待时间指数增长
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
 async def identify_rules(rule):
     return await api_request(Config.IDENTIFY_RULES_URL, {"rule": rule})
 
@@ -90,40 +151,48 @@ async def classify_rules(rule):
 
 
 async def process_rule(rule) -> SuperViseGroup:
-    identify_rule_result = await identify_rules(rule)
-
-    data_value = identify_rule_result['data']
+    # 近似重复的原子条例直接复用已有分类，不再请求上游
+    reused = find_similar('classify', rule)
+    if reused is not None:
+        return SuperViseGroup(**reused)
 
     auto_supervised_value = AutoSupervision.AUTO_SUPERVISED.value
 
+    # 只有可自动监管的条例需要分类，投机模式下识别与分类同时发起
+    identify_rule_result, classification = await run_dependent(
+        'identify_classify', lambda: identify_rules(rule), lambda: classify_rules(rule),
+        lambda result: result['data'] == auto_supervised_value)
+
+    data_value = identify_rule_result['data']
+
     if data_value == auto_supervised_value:
-        classification = await classify_rules(rule)
 
         # 确保分类结果中的category和type是有效的
         category = classification.get('category', "") if classification else ""
         supervise_type = classification.get('type', "") if classification else ""
 
-        return SuperViseGroup(
+        super_vise_group = SuperViseGroup(
             supervise=str(auto_supervised_value),
             supervise_category=category,
             supervise_type=supervise_type
         )
+        if classification and 'error' not in classification:
+            remember('classify', rule, super_vise_group.model_dump())
+        return super_vise_group
     else:
-        return SuperViseGroup(
+        super_vise_group = SuperViseGroup(
             supervise=str(AutoSupervision.NOT_AUTO_SUPERVISED.value),
             supervise_category="",
             supervise_type=""
         )
+        remember('classify', rule, super_vise_group.model_dump())
+        return super_vise_group
 
 
-@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=1, max=10))
 async def extract_common_element(rule, category):
-    async with semaphore:
-        await rate_limiter.wait()
-        return await api_request(Config.EXTRACT_COMMON_RULES_URL, {"rule": rule, "category": category})
+    return await api_request(Config.EXTRACT_COMMON_RULES_URL, {"rule": rule, "category": category})
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
 async def generate_cdsrl(rule, category, entity_info):
     return await api_request(Config.GENERATE_CDSRL_URL,
                              {"rule": rule, "category": category, "entity_info": entity_info})
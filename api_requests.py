@@ -1,18 +1,143 @@
-from backoff import on_exception, expo
-from httpx import AsyncClient
+import time
+from typing import Optional
+
+from httpx import AsyncClient, Limits, Timeout
+
+from config import Config
+from logger import get_logger
+from metrics import (CallbackCounter, Gauge, UPSTREAM_LATENCY, UPSTREAM_REQUEST_BYTES, UPSTREAM_REQUESTS,
+                     UPSTREAM_RESPONSE_BYTES, registry)
+from rate_limiter import endpoint_name, get_limiter
+from retry_policy import UpstreamError, retry_policy
+from scheduler import get_scheduler
+
+logger = get_logger(__name__)
+
+
+class PoolStats:
+    """
+    连接池统计：请求数与新建连接数之差即为复用次数
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+
+    async def trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+
+    def snapshot(self, client: Optional[AsyncClient] = None):
+        reused = max(self.requests - self.new_connections, 0)
+        stats = {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": reused,
+            "reuse_rate": round(reused / self.requests, 4) if self.requests else 0.0,
+        }
+        # httpx 未公开连接池状态，这里读取 httpcore 的连接列表
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            stats["open_connections"] = len(connections)
+            stats["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+        return stats
 
 
 class APIRequest:
+    client: Optional[AsyncClient] = None
+    stats = PoolStats()
+
+    @classmethod
+    def create_client(cls) -> AsyncClient:
+        http2 = Config.HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("h2 is not installed, falling back to HTTP/1.1")
+                http2 = False
+        return AsyncClient(
+            http2=http2,
+            limits=Limits(max_connections=Config.HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY),
+            timeout=Timeout(connect=Config.HTTP_CONNECT_TIMEOUT,
+                            read=Config.HTTP_READ_TIMEOUT,
+                            write=Config.HTTP_WRITE_TIMEOUT,
+                            pool=Config.HTTP_POOL_TIMEOUT),
+        )
+
+    @classmethod
+    async def startup(cls):
+        if cls.client is None:
+            cls.client = cls.create_client()
+
+    @classmethod
+    async def shutdown(cls):
+        if cls.client is not None:
+            await cls.client.aclose()
+            cls.client = None
+
+    @classmethod
+    def pool_stats(cls):
+        return cls.stats.snapshot(cls.client)
+
+    @classmethod
+    async def post(cls, url: str, data=None, files=None):
+        # 重试、截止时间和熔断统一由 retry_policy 处理；每次尝试单独在调度器中排队，
+        # 重试退避期间不占用并发名额，其他调用方可以先执行
+        return await retry_policy.call(url, lambda: cls._scheduled_post(url, data, files))
+
+    @classmethod
+    async def _scheduled_post(cls, url: str, data=None, files=None):
+        async with get_scheduler(url).slot():
+            return await cls._post_once(url, data, files)
+
+    @classmethod
+    async def _post_once(cls, url: str, data=None, files=None):
+        # 未经过应用生命周期启动时（如脚本直接调用）按需创建共享客户端
+        if cls.client is None:
+            cls.client = cls.create_client()
+        limiter = get_limiter(url)
+        endpoint = endpoint_name(url)
+        async with limiter.slot():
+            cls.stats.requests += 1
+            start = time.monotonic()
+            try:
+                response = await cls.client.post(url, json=data, files=files, extensions={"trace": cls.stats.trace})
+            except Exception as e:
+                latency = time.monotonic() - start
+                limiter.record(None, latency)
+                UPSTREAM_REQUESTS.inc(endpoint=endpoint, status=type(e).__name__)
+                UPSTREAM_LATENCY.observe(latency, endpoint=endpoint, status=type(e).__name__)
+                raise
+            latency = time.monotonic() - start
+            limiter.record(response.status_code, latency)
+        UPSTREAM_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        UPSTREAM_LATENCY.observe(latency, endpoint=endpoint, status=response.status_code)
+        UPSTREAM_REQUEST_BYTES.inc(int(response.request.headers.get("content-length", 0)), endpoint=endpoint)
+        UPSTREAM_RESPONSE_BYTES.inc(len(response.content), endpoint=endpoint)
+        logger.debug("upstream response", extra={"fields": {"endpoint": endpoint, "status": response.status_code,
+                                                            "latency": round(latency, 3)}})
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 429 or response.status_code >= 500:
+            raise UpstreamError(url, response.status_code)
+        else:
+            return {"error": "Request failed", "status_code": response.status_code}
+
+
+def _pool_values():
+    stats = APIRequest.pool_stats()
+    return {(state,): stats[f"{state}_connections"] for state in ("open", "idle") if f"{state}_connections" in stats}
+
 
-    @staticmethod
-    @on_exception(expo, Exception, max_tries=5)
-    async def post(url: str, data=None, files=None):
-        async with AsyncClient(timeout=None) as client:
-            response = await client.post(url, json=data, files=files)
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 500:
-                print(f"Server error for URL: {url}, retrying...")
-                raise Exception("Server error")
-            else:
-                return {"error": "Request failed", "status_code": response.status_code}
+registry.register(CallbackCounter(
+    'http_pool_requests_total', 'Requests sent through the shared HTTP client', (),
+    lambda: {(): APIRequest.stats.requests}))
+registry.register(CallbackCounter(
+    'http_pool_new_connections_total', 'New TCP connections opened by the shared HTTP client', (),
+    lambda: {(): APIRequest.stats.new_connections}))
+registry.register(Gauge('http_pool_connections', 'Connections held by the shared HTTP client', ('state',),
+                        _pool_values))
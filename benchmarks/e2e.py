@@ -0,0 +1,194 @@
+"""
+端到端吞吐量压测：启动本地模拟上游，驱动真实的 FastAPI 应用执行 /upload_file、/modify、/count，
+输出 files/min、rules/sec、上游调用 p50/p99 延迟和峰值内存。
+
+    python -m benchmarks.e2e --files 10 --rules-per-doc 50 --latency-mean 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+import httpx
+
+from benchmarks.mock_upstream import MockSettings
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def start_mock(port: int, settings: MockSettings) -> subprocess.Popen:
+    command = [sys.executable, "-m", "benchmarks.mock_upstream", "--port", str(port)]
+    for name, value in vars(settings).items():
+        command += [f"--{name.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Mock upstream did not start")
+
+
+class LatencyRecorder:
+    """
+    记录共享 HTTP 客户端每次上游调用的耗时（不含限流等待）
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+
+    def install(self, client: httpx.AsyncClient):
+        original_post = client.post
+
+        async def timed_post(url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await original_post(url, *args, **kwargs)
+            finally:
+                self.latencies[str(url).rsplit('/', 1)[-1]].append(time.perf_counter() - start)
+
+        client.post = timed_post
+
+    def summary(self):
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        result = {"all": self._describe(all_latencies)}
+        for endpoint, values in sorted(self.latencies.items()):
+            result[endpoint] = self._describe(values)
+        return result
+
+    @staticmethod
+    def _describe(values):
+        return {"calls": len(values), "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1)}
+
+
+def make_documents(folder: str, count: int):
+    for index in range(count):
+        with open(os.path.join(folder, f"document_{index:04d}.docx"), "wb") as file:
+            file.write(os.urandom(64 * 1024))
+
+
+async def run(args, base_url: str, work_dir: str):
+    # 必须在导入应用之前设置，Config 在导入时读取上游地址
+    os.environ["SUPERVISE_BASE_URL"] = base_url
+    from config import Config
+    Config.CACHE_PATH = os.path.join(work_dir, "cache.sqlite3")
+    Config.RESULTS_STORE_PATH = os.path.join(work_dir, "results.sqlite3")
+    Config.SIMILARITY_PATH = os.path.join(work_dir, "similarity.sqlite3")
+    import main
+    from api_requests import APIRequest
+
+    origin_folder = os.path.join(work_dir, "origin")
+    target_folder = os.path.join(work_dir, "target")
+    os.makedirs(origin_folder)
+    make_documents(origin_folder, args.files)
+
+    recorder = LatencyRecorder()
+    report = {"settings": vars(args), "scenarios": {}}
+    async with main.lifespan(main.app):
+        recorder.install(APIRequest.client)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=None) as client:
+            scenarios = [
+                ("upload_file", "/upload_file", {"origin_folder": origin_folder, "target_folder": target_folder,
+                                                 "cache": args.cache, "resume": "false"}),
+                ("modify", "/modify", {"folder": target_folder, "cache": args.cache, "resume": "false"}),
+                ("count", "/count", {"target_folder": target_folder}),
+                # 融合流水线：一次完成 upload_file + modify
+                ("pipeline", "/upload_file", {"origin_folder": origin_folder,
+                                              "target_folder": os.path.join(work_dir, "pipeline"),
+                                              "cache": args.cache, "resume": "false", "fused": "true"}),
+            ]
+            for name, path, params in scenarios:
+                if name not in args.scenarios:
+                    continue
+                stats_before = httpx.get(f"{base_url}/stats").json()
+                start = time.perf_counter()
+                response = await client.post(path, params=params)
+                elapsed = time.perf_counter() - start
+                stats_after = httpx.get(f"{base_url}/stats").json()
+                calls = {key: value - stats_before["calls"].get(key, 0) for key, value in stats_after["calls"].items()}
+                succeeded = {key: value - stats_before["statuses"].get(key, 0)
+                             for key, value in stats_after["statuses"].items()}
+                # 以成功的调用数计算条例数，不含重试
+                if name in ("upload_file", "pipeline"):
+                    rules = succeeded.get("checkAtomRule:200", 0)
+                elif name == "modify":
+                    rules = succeeded.get("generateCDSRL:200", 0)
+                else:
+                    rules = response.json().get("total_count", 0)
+                report["scenarios"][name] = {
+                    "status_code": response.status_code,
+                    "seconds": round(elapsed, 3),
+                    "files_per_minute": round(args.files / elapsed * 60, 2),
+                    "rules": rules,
+                    "rules_per_second": round(rules / elapsed, 2),
+                    "upstream_calls": calls,
+                }
+    report["latency"] = recorder.summary()
+    return report
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against a local mock upstream")
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--scenarios", nargs="+", default=["upload_file", "modify", "count"],
+                        choices=["upload_file", "modify", "count", "pipeline"])
+    parser.add_argument("--cache", default="bypass", choices=["use", "bypass", "refresh"])
+    parser.add_argument("--output", help="write the JSON report to this path")
+    for name, value in vars(MockSettings()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args(argv)
+    settings = MockSettings(**{name: getattr(args, name) for name in vars(MockSettings())})
+
+    port = free_port()
+    mock = start_mock(port, settings)
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = asyncio.run(run(args, f"http://127.0.0.1:{port}", work_dir))
+    finally:
+        mock.terminate()
+        mock.wait()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report["memory"] = {"python_peak_mb": round(peak / 1024 / 1024, 2)}
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 单位为 KB，macOS 为字节
+        report["memory"]["max_rss_mb"] = round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 2)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,219 @@
+"""
+工作簿层微基准：生成 1k/10k/100k 行的合成结果工作簿（含合并的原子条例组和长中文文本），
+分别计时生成工作簿、/modify 的读取与写回、美化、设置列宽和 /count，记录 Python 堆峰值内存，
+并与保存的基线比较，变慢或内存上涨超过容差时以非零状态退出。
+
+    python -m benchmarks.excel --rows 1000 10000 --save-baseline benchmarks/excel_baseline.json
+    python -m benchmarks.excel --rows 1000 10000 --baseline benchmarks/excel_baseline.json
+
+benchmarks/excel_baseline.json 是 1k、10k 行的参考基线（环境信息见文件中的 environment）。
+基线与机器相关，在其他机器或 CI 节点上比较前，先在该机器上用 --save-baseline 重新生成并提交。
+单核或共享的机器上 1k 行用例的计时抖动可达 50% 以上，比较时应加大 --tolerance（如 1.0）或只比较 10k 以上的行数。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import openpyxl
+
+from constant import AutoSupervision
+from excel_reader import count_automatable
+from main import ENRICH_HEADERS, HEADERS, save_excel
+from model import RuleObject
+from transforms import (BeautifyTransform, ColumnWidthTransform, EnrichTransform, read_enrich_rows,
+                        transform_workbook)
+
+CASES = ["write", "read_enrich", "enrich", "beautify", "column_width", "count"]
+
+PHRASES = [
+    "在本市从事网络预约出租汽车经营服务的", "应当取得相应的经营许可", "驾驶员应当持有有效的机动车驾驶证",
+    "车辆应当安装具有行驶记录功能的车辆卫星定位装置", "平台公司应当按照国家有关规定", "向监管部门实时报送相关数据",
+    "不得以低于成本的价格运营扰乱正常市场秩序", "应当建立乘客投诉处理制度", "并在规定时限内处理完毕",
+    "违反本办法规定的", "由交通运输主管部门责令改正", "处以一万元以上三万元以下罚款", "情节严重的，吊销经营许可",
+    "个人信息的收集、使用应当遵守国家有关规定", "未经同意不得向第三方提供",
+]
+
+
+def chinese_text(rng: random.Random, min_chars: int, max_chars: int) -> str:
+    target = rng.randint(min_chars, max_chars)
+    parts = []
+    size = 0
+    while size < target:
+        phrase = rng.choice(PHRASES)
+        parts.append(phrase)
+        size += len(phrase) + 1
+    return "，".join(parts) + "。"
+
+
+def make_result_rows(rows: int, seed: int = 1) -> Tuple[List[RuleObject], List[List[Any]]]:
+    """
+    生成与 save_excel 相同结构的数据：每条条例 1~4 个原子条例，约一半可自动监管并带有 CDSRL 结果
+    """
+    rng = random.Random(seed)
+    groups = []
+    results = []
+    rule_number = 0
+    while len(results) < rows:
+        rule_number += 1
+        atoms = min(rng.choice([1, 1, 2, 3, 4]), rows - len(results))
+        rule_content = chinese_text(rng, 80, 300)
+        atom_rules = [chinese_text(rng, 30, 150) for _ in range(atoms)]
+        groups.append(RuleObject(rule_order=f"第{rule_number}条", rule_content=rule_content,
+                                 atom="1" if atoms == 1 else "0", atom_rules=atom_rules))
+        for atom_rule in atom_rules:
+            if rng.random() < 0.5:
+                common_element = json.dumps({"subject": chinese_text(rng, 10, 30), "action": atom_rule[:20]},
+                                            ensure_ascii=False)
+                cdsrl = json.dumps({"cdsrl": f"RULE r{len(results)} WHEN {chinese_text(rng, 40, 120)}"},
+                                   ensure_ascii=False)
+                results.append([str(AutoSupervision.AUTO_SUPERVISED.value), "内容监管", "许可", common_element, cdsrl])
+            else:
+                results.append([str(AutoSupervision.NOT_AUTO_SUPERVISED.value), "", "", "", ""])
+    return groups, results
+
+
+def write_workbook(file_path: str, groups: List[RuleObject], results: List[List[Any]]):
+    # 直接调用服务的 save_excel；未启动进程池，保存在默认线程池中执行
+    asyncio.run(save_excel(os.path.basename(file_path), os.path.dirname(file_path), HEADERS + ENRICH_HEADERS,
+                           groups, results))
+
+
+def apply_transform(file_path: str, transform) -> None:
+    result = transform_workbook(file_path, [transform])
+    if result["status"] != "Modified":
+        raise RuntimeError(f"{transform.step.value} failed: {result}")
+
+
+def prepare_enrich(file_path: str) -> EnrichTransform:
+    # 模拟 prepare 的结果：所有可自动监管的行都写回新的两列
+    transform = EnrichTransform()
+    transform.updates = {row_index: (json.dumps({"subject": content[:20]}, ensure_ascii=False),
+                                     json.dumps({"cdsrl": f"RULE {category} {content}"}, ensure_ascii=False))
+                         for row_index, content, category in read_enrich_rows(file_path)}
+    return transform
+
+
+def build_cases(base_path: str, work_path: str, groups, results) -> Dict[str, Tuple[Callable, Callable]]:
+    """
+    每个用例为 (准备, 执行)，准备阶段（复制输入文件等）不计时
+    """
+    def copy_base():
+        shutil.copyfile(base_path, work_path)
+
+    def copy_for_enrich():
+        copy_base()
+        return prepare_enrich(work_path)
+
+    return {
+        "write": (lambda: None, lambda _: write_workbook(work_path, groups, results)),
+        "read_enrich": (lambda: None, lambda _: read_enrich_rows(base_path)),
+        "enrich": (copy_for_enrich, lambda transform: apply_transform(work_path, transform)),
+        "beautify": (copy_base, lambda _: apply_transform(work_path, BeautifyTransform())),
+        "column_width": (copy_base, lambda _: apply_transform(work_path, ColumnWidthTransform(30))),
+        "count": (lambda: None, lambda _: count_automatable(base_path)),
+    }
+
+
+def measure(prepare: Callable, run: Callable, repeat: int) -> Dict[str, float]:
+    # 计时与内存分开测量，tracemalloc 会明显拖慢执行
+    timings = []
+    for _ in range(repeat):
+        state = prepare()
+        start = time.perf_counter()
+        run(state)
+        timings.append(time.perf_counter() - start)
+    state = prepare()
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(min(timings), 4), "peak_mb": round(peak / 1024 / 1024, 2)}
+
+
+def run_size(rows: int, cases: List[str], repeat: int, work_dir: str) -> Dict[str, Dict[str, float]]:
+    groups, results = make_result_rows(rows)
+    base_path = os.path.join(work_dir, f"base_{rows}.xlsx")
+    work_path = os.path.join(work_dir, f"work_{rows}.xlsx")
+    write_workbook(base_path, groups, results)
+    available = build_cases(base_path, work_path, groups, results)
+    report = {}
+    for case in cases:
+        prepare, run = available[case]
+        report[case] = measure(prepare, run, repeat)
+        print(f"{rows:>7} rows  {case:<13} {report[case]['seconds']:>9.3f}s  {report[case]['peak_mb']:>9.2f} MB",
+              file=sys.stderr)
+    return report
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta: float) -> List[str]:
+    """
+    返回超过容差的项；耗时还需超过 min_delta 秒，避免极短用例的计时抖动误报
+    """
+    regressions = []
+    for size, cases in report["results"].items():
+        for case, current in cases.items():
+            previous = baseline.get("results", {}).get(size, {}).get(case)
+            if previous is None:
+                continue
+            seconds_limit = max(previous["seconds"] * (1 + tolerance), previous["seconds"] + min_delta)
+            if current["seconds"] > seconds_limit:
+                regressions.append(f"{case} @ {size} rows: {current['seconds']}s vs baseline {previous['seconds']}s")
+            if current["peak_mb"] > previous["peak_mb"] * (1 + tolerance) + 1:
+                regressions.append(f"{case} @ {size} rows: {current['peak_mb']} MB vs baseline "
+                                   f"{previous['peak_mb']} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spreadsheet layer microbenchmarks on synthetic result workbooks")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the fastest is reported")
+    parser.add_argument("--baseline", help="compare against this JSON report and exit 1 on regressions")
+    parser.add_argument("--save-baseline", help="write the report to this path as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown or memory growth")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="ignore slowdowns smaller than this (seconds)")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    args = parser.parse_args()
+
+    report = {
+        "environment": {"python": platform.python_version(), "openpyxl": openpyxl.__version__,
+                        "platform": platform.platform()},
+        "repeat": args.repeat,
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="supervise_excel_bench_") as work_dir:
+        for rows in args.rows:
+            report["results"][str(rows)] = run_size(rows, args.cases, args.repeat, work_dir)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"PERFORMANCE REGRESSION against {args.baseline}:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+本地模拟上游服务，实现 Config 中的全部接口，用于压测和回归测试，不消耗真实上游额度。
+
+    python -m benchmarks.mock_upstream --port 9000 --latency-mean 0.2 --error-rate 0.01 --throttle-rate 0.02
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+from collections import Counter
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import JSONResponse
+
+from constant import AutoSupervision, ClauseType, RegulationType
+
+
+@dataclass
+class MockSettings:
+    latency_dist: str = "lognormal"  # fixed | uniform | lognormal
+    latency_mean: float = 0.2  # 平均延迟（秒）
+    latency_sigma: float = 0.5  # lognormal 的 sigma，uniform 时为 ±比例
+    error_rate: float = 0.0  # 返回 500 的比例
+    throttle_rate: float = 0.0  # 返回 429 的比例
+    rules_per_doc: int = 50  # 每个文档拆出的条例数
+    atoms_per_rule: int = 3  # 复杂条例拆出的原子条例数
+    complex_ratio: float = 0.7  # 复杂条例比例
+    auto_ratio: float = 0.8  # 可自动监管比例
+    seed: int = 0
+
+
+def stable_fraction(*parts) -> float:
+    # 相同输入得到相同结果，保证缓存、合并等行为可复现
+    digest = hashlib.sha256("\n".join(str(part) for part in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(settings.seed)
+    calls = Counter()
+    statuses = Counter()
+
+    def latency() -> float:
+        if settings.latency_dist == "fixed":
+            return settings.latency_mean
+        if settings.latency_dist == "uniform":
+            spread = settings.latency_mean * settings.latency_sigma
+            return max(0.0, rng.uniform(settings.latency_mean - spread, settings.latency_mean + spread))
+        # 对数正态分布，均值为 latency_mean
+        mu = -settings.latency_sigma ** 2 / 2
+        return settings.latency_mean * rng.lognormvariate(mu, settings.latency_sigma)
+
+    async def simulate(endpoint: str):
+        calls[endpoint] += 1
+        await asyncio.sleep(latency())
+        roll = rng.random()
+        if roll < settings.throttle_rate:
+            statuses[f"{endpoint}:429"] += 1
+            return JSONResponse({"error": "Too Many Requests"}, status_code=429)
+        if roll < settings.throttle_rate + settings.error_rate:
+            statuses[f"{endpoint}:500"] += 1
+            return JSONResponse({"error": "Internal Server Error"}, status_code=500)
+        statuses[f"{endpoint}:200"] += 1
+        return None
+
+    @app.post("/docxFile2rule")
+    async def docx_file2rule(file: UploadFile = File(...)):
+        content = await file.read()
+        error = await simulate("docxFile2rule")
+        if error:
+            return error
+        doc_id = hashlib.sha256(content).hexdigest()[:8]
+        return {"ruleList": [
+            {"rule_order": f"第{index}条",
+             "rule_content": f"（{doc_id}-{index}）在本市从事网络预约出租汽车经营服务的，应当符合下列条件：第{index}项要求。"}
+            for index in range(1, settings.rules_per_doc + 1)
+        ]}
+
+    @app.post("/checkAtomRule")
+    async def check_atom_rule(request: Request):
+        rule = (await request.json())["rule"]
+        error = await simulate("checkAtomRule")
+        if error:
+            return error
+        is_complex = stable_fraction("complex", rule) < settings.complex_ratio
+        return {"data": ClauseType.COMPLEX_CLAUSE.value if is_complex else ClauseType.ATOMIC_CLAUSE.value}
+
+    @app.post("/splitAtomRule")
+    async def split_atom_rule(request: Request):
+        rule = (await request.json())["rule"]
+        error = await simulate("splitAtomRule")
+        if error:
+            return error
+        return {"ruleList": [{"atom_rule": f"{rule}（{index}）"} for index in range(1, settings.atoms_per_rule + 1)]}
+
+    @app.post("/identifyRule")
+    async def identify_rule(request: Request):
+        rule = (await request.json())["rule"]
+        error = await simulate("identifyRule")
+        if error:
+            return error
+        is_auto = stable_fraction("auto", rule) < settings.auto_ratio
+        return {"data": AutoSupervision.AUTO_SUPERVISED.value if is_auto else
+                AutoSupervision.NOT_AUTO_SUPERVISED.value}
+
+    @app.post("/classifyRule")
+    async def classify_rule(request: Request):
+        rule = (await request.json())["rule"]
+        error = await simulate("classifyRule")
+        if error:
+            return error
+        categories = list(RegulationType)
+        category = categories[int(stable_fraction("category", rule) * len(categories))]
+        return {"category": category.value, "type": f"type-{int(stable_fraction('type', rule) * 5)}"}
+
+    @app.post("/extractCommonElement")
+    async def extract_common_element(request: Request):
+        body = await request.json()
+        error = await simulate("extractCommonElement")
+        if error:
+            return error
+        return {"subject": "网约车平台公司", "object": body["rule"][:20], "category": body["category"],
+                "attributes": {"deadline": "3年", "region": "本市"}}
+
+    @app.post("/generateCDSRL")
+    async def generate_cdsrl(request: Request):
+        body = await request.json()
+        error = await simulate("generateCDSRL")
+        if error:
+            return error
+        return {"cdsrl": f"RULE {body['category']} WHEN subject = '{body['entity_info'].get('subject', '')}' "
+                         f"THEN REQUIRE compliant"}
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": dict(calls), "statuses": dict(statuses)}
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local mock of the upstream rule service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    for name, value in vars(MockSettings()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    settings = MockSettings(**{name: getattr(args, name) for name in vars(MockSettings())})
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
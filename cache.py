@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Optional
+
+from config import Config
+from constant import CacheMode
+from metrics import CallbackCounter, Gauge, registry
+
+# 当前请求的缓存模式，由接口参数设置，随任务上下文传递到所有上游调用
+cache_mode: ContextVar[CacheMode] = ContextVar("cache_mode", default=CacheMode.USE)
+
+
+def canonical_json(payload: Any) -> str:
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def make_key(endpoint: str, payload: Any) -> str:
+    return hashlib.sha256(f"{endpoint}\n{canonical_json(payload)}".encode("utf-8")).hexdigest()
+
+
+def stream_digest(file: BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    """
+    按块计算文件对象的 sha256，不把整个文件读入内存，计算完回到文件开头
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    基于 SQLite 的接口结果缓存，按接口地址和请求内容哈希寻址，
+    支持过期时间以及按条数、字节数的 LRU 淘汰
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # 命中时只在内存中记录访问时间，随下一次写入一起提交，读路径不写盘
+        self._touched: Dict[str, float] = {}
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, endpoint TEXT NOT NULL, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed_at ON cache (accessed_at)")
+        self._conn.commit()
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+
+    def get(self, endpoint: str, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, size, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl and now - row[2] > self.ttl:
+                self._delete(key, row[1])
+                row = None
+            if row is None:
+                self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= Config.CACHE_TOUCH_BATCH:
+                self._flush_touched()
+                self._conn.commit()
+            self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+        return json.loads(row[0])
+
+    def set(self, endpoint: str, key: str, value: Any):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._entries -= 1
+                self._bytes -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, endpoint, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, endpoint, data, size, now, now))
+            self._entries += 1
+            self._bytes += size
+            self._touched.pop(key, None)
+            self._evict()
+            self._conn.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?",
+                                   [(accessed_at, key) for key, accessed_at in self._touched.items()])
+            self._touched.clear()
+
+    def _delete(self, key: str, size: int):
+        self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        self._conn.commit()
+        self._entries -= 1
+        self._bytes -= size
+
+    def _evict(self):
+        # 超出条数或字节上限时，按最近访问时间淘汰最旧的记录，先写入尚未提交的访问时间
+        if self._entries > self.max_entries or self._bytes > self.max_bytes:
+            self._flush_touched()
+        while self._entries > self.max_entries or self._bytes > self.max_bytes:
+            batch = max(self._entries - self.max_entries, 1)
+            rows = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY accessed_at LIMIT ?", (batch,)).fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", [(row[0],) for row in rows])
+            self._entries -= len(rows)
+            self._bytes -= sum(row[1] for row in rows)
+            self.evictions += len(rows)
+
+    def stats(self):
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "evictions": self.evictions,
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "endpoints": {
+                endpoint: {"hits": self.hits.get(endpoint, 0), "misses": self.misses.get(endpoint, 0)}
+                for endpoint in endpoints
+            },
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def get_cache() -> Optional[ResultCache]:
+    global _result_cache
+    if not Config.CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        _result_cache = ResultCache(Config.CACHE_PATH, Config.CACHE_TTL, Config.CACHE_MAX_ENTRIES,
+                                    Config.CACHE_MAX_BYTES)
+    return _result_cache
+
+
+def close_cache():
+    global _result_cache
+    if _result_cache is not None:
+        _result_cache.close()
+        _result_cache = None
+
+
+def cacheable(result: Any) -> bool:
+    # 只缓存成功的结果，错误信息需要下次重新请求
+    return isinstance(result, dict) and "error" not in result
+
+
+async def cached(endpoint: str, payload: Any, fetch: Callable[[], Awaitable[Any]]):
+    cache = get_cache()
+    mode = cache_mode.get()
+    if cache is None or mode == CacheMode.BYPASS:
+        return await fetch()
+
+    key = make_key(endpoint, payload)
+    if mode == CacheMode.USE:
+        result = cache.get(endpoint, key)
+        if result is not None:
+            return result
+
+    result = await fetch()
+    if cacheable(result):
+        cache.set(endpoint, key, result)
+    return result
+
+
+def _cache_counts(attribute: str):
+    def values():
+        if _result_cache is None:
+            return {}
+        counts = getattr(_result_cache, attribute)
+        return {(endpoint.rstrip('/').rsplit('/', 1)[-1],): count for endpoint, count in counts.items()}
+    return values
+
+
+registry.register(CallbackCounter('cache_hits_total', 'Result cache hits', ('endpoint',), _cache_counts('hits')))
+registry.register(CallbackCounter('cache_misses_total', 'Result cache misses', ('endpoint',), _cache_counts('misses')))
+registry.register(CallbackCounter('cache_evictions_total', 'Result cache LRU evictions', (),
+                                  lambda: {(): _result_cache.evictions} if _result_cache else {}))
+registry.register(Gauge('cache_entries', 'Entries in the result cache', (),
+                        lambda: {(): _result_cache._entries} if _result_cache else {}))
+registry.register(Gauge('cache_bytes', 'Bytes stored in the result cache', (),
+                        lambda: {(): _result_cache._bytes} if _result_cache else {}))
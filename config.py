@@ -1,5 +1,8 @@
+import os
+
+
 class Config:
-    BASE_URL = "http://120.26.59.7:23262"
+    BASE_URL = os.getenv("SUPERVISE_BASE_URL", "http://120.26.59.7:23262")  # 可通过环境变量指向本地模拟服务
     UPLOAD_FILE_URL = f"{BASE_URL}/docxFile2rule"  # 上传文件
     CHECK_ATOM_RULE_URL = f"{BASE_URL}/checkAtomRule"  # 判断原子条例
     SPLIT_ATOMIC_RULES_URL = f"{BASE_URL}/splitAtomRule"  # 分割原子规则
@@ -7,3 +10,102 @@ class Config:
     CLASSIFY_RULES_URL = f"{BASE_URL}/classifyRule"  # 分类规则
     EXTRACT_COMMON_RULES_URL = f"{BASE_URL}/extractCommonElement"  # 提取通用规则
     GENERATE_CDSRL_URL = f"{BASE_URL}/generateCDSRL"  # 输出条例对应的监管语⾔
+
+    # HTTP 连接池配置，所有上游请求共享同一个客户端
+    HTTP_MAX_CONNECTIONS = 100  # 最大连接数
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = 20  # 最大保活连接数
+    HTTP_KEEPALIVE_EXPIRY = 30.0  # 空闲连接保活时间（秒）
+    HTTP2 = False  # 是否启用 HTTP/2（需要安装 h2）
+    HTTP_CONNECT_TIMEOUT = 10.0  # 建立连接超时（秒）
+    HTTP_READ_TIMEOUT = 300.0  # 读取超时（秒），大模型接口响应较慢
+    HTTP_WRITE_TIMEOUT = 60.0  # 发送超时（秒），上传文件可能较大
+    HTTP_POOL_TIMEOUT = 30.0  # 等待连接池空闲连接超时（秒）
+
+    # 接口结果缓存
+    CACHE_ENABLED = True
+    CACHE_PATH = "cache/llm_cache.sqlite3"  # 缓存数据库路径
+    CACHE_TTL = 30 * 24 * 3600  # 缓存有效期（秒），0 表示永不过期
+    CACHE_MAX_ENTRIES = 200_000  # 最大缓存条数
+    CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 最大缓存字节数
+    CACHE_TOUCH_BATCH = 1000  # 命中后的访问时间累积多少条写入一次（LRU 淘汰依据）
+
+    # 处理结果库，保存每个文档的条例、原子条例、分类和 CDSRL，可查询统计、按需导出 xlsx
+    RESULTS_STORE_ENABLED = True
+    RESULTS_STORE_PATH = "data/results.sqlite3"
+
+    # 近似重复条例复用（默认关闭）：归一化后字符 3-gram 的 Jaccard 相似度不低于阈值、且数字和日期完全一致时
+    # 复用已有的分类结果，CDSRL 不复用；只在缓存模式为 use 时生效
+    SIMILARITY_ENABLED = False
+    SIMILARITY_PATH = "cache/similarity.sqlite3"
+    SIMILARITY_THRESHOLD = 0.9
+    SIMILARITY_NUM_PERM = 64  # MinHash 签名长度
+    SIMILARITY_BANDS = 16  # LSH 分桶数，每个桶 NUM_PERM / BANDS 行
+    SIMILARITY_MAX_ENTRIES = 100_000  # 索引最多保留的条目数，超出时淘汰最早的
+
+    # 单个文件内条例处理的并发数
+    RULE_CONCURRENCY = 8
+
+    # /upload_file 同时上传的文件数
+    UPLOAD_CONCURRENCY = 4
+
+    # 分块提取（chunked=true）：本地解析 .docx，按“第X条”对齐切成不超过 CHUNK_MAX_CHARS 字的小文件并发上传
+    CHUNK_MAX_CHARS = 4000
+    CHUNK_CONCURRENCY = 4  # 单个文件同时上传的块数
+
+    # 投机调用：判断原子条例与拆分、识别与分类同时发起，省去一次串行往返，不需要的结果丢弃。
+    # off / on / auto，auto 时第二个调用的命中率（EWMA）不低于 SPECULATION_MIN_HIT_RATE 才投机
+    SPECULATION_MODE = "off"
+    SPECULATION_MIN_HIT_RATE = 0.7
+    SPECULATION_WARMUP = 20  # auto 模式开始投机前至少观察的条例数
+    SPECULATION_EWMA_ALPHA = 0.05  # 命中率的平滑系数
+
+    # 按接口名配置限流：rate 每秒请求数，burst 令牌桶容量，concurrency 最大并发数，
+    # adaptive 为 True 时按 AIMD 在 [min_rate, max_rate] 内自动调整速率
+    RATE_LIMITS = {
+        "default": {"rate": 10, "burst": 10, "concurrency": 16, "adaptive": True,
+                    "min_rate": 0.5, "max_rate": 50, "increase": 1.0, "decrease": 0.5,
+                    "target_latency": 30.0, "cooldown": 5.0},
+        "docxFile2rule": {"rate": 2, "burst": 2, "concurrency": 4},
+        "extractCommonElement": {"rate": 1, "burst": 1, "concurrency": 5},
+    }
+
+    # 上游调用调度：每个接口的并发数与 RATE_LIMITS 中的 concurrency 一致，超出的请求按调用方分队列，
+    # 按优先级和轮转公平执行
+    SCHEDULER_QUEUE_SIZE = 64  # 每个调用方在单个接口上最多排队的请求数，队列满时提交方等待
+    SCHEDULER_AGING = 30.0  # 排队每超过多少秒提升一级优先级（秒）
+    SCHEDULER_DEADLINE_SLACK = 5.0  # 距截止时间不足多少秒的请求在同一优先级内优先执行（秒）
+
+    # 重试策略，所有上游请求共用一层重试
+    RETRY_MAX_ATTEMPTS = 4  # 单次调用最多尝试次数
+    RETRY_BASE_DELAY = 1.0  # 退避基础时间（秒）
+    RETRY_MAX_DELAY = 10.0  # 退避最长时间（秒）
+    RETRY_BUDGET_RATIO = 0.2  # 重试预算：每个请求可为重试存入的令牌数
+    RETRY_BUDGET_MIN = 10  # 初始重试令牌数
+    RETRY_BUDGET_MAX = 100  # 重试令牌上限
+    CALL_DEADLINE = 600.0  # 单次调用（含重试）截止时间（秒）
+    JOB_DEADLINE = None  # 单个任务截止时间（秒），None 表示不限制
+    CIRCUIT_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+    CIRCUIT_RESET_TIMEOUT = 30.0  # 熔断后多久尝试恢复（秒）
+
+    # 工作簿读写、统计等 CPU 密集操作的进程数，None 表示使用 CPU 核数，0 表示不用进程池（改用线程池）
+    CPU_WORKERS = None
+
+    # 多 worker 部署：uvicorn 启动的进程数。大于 1 时上游限流、并发名额和后台任务状态
+    # 通过本地 SQLite 文件在进程间共享，CPU_WORKERS 为 None 时进程池按 worker 数均分 CPU 核
+    WORKERS = int(os.getenv("SUPERVISE_WORKERS", "1"))
+    SHARED_STATE_PATH = "cache/shared_state.sqlite3"
+    SHARED_POLL_INTERVAL = 0.05  # 共享并发名额已满时的初始轮询间隔（秒），连续失败时加倍
+    SHARED_POLL_MAX_INTERVAL = 1.0  # 轮询间隔上限（秒），本进程归还名额时立即唤醒等待者
+    SHARED_BUSY_TIMEOUT = 0.5  # 等待其他 worker 释放 SQLite 写锁的最长时间（秒），超时后稍后重试
+    SHARED_LEASE_TTL = 900.0  # 并发名额最长持有时间（秒），worker 异常退出后到期自动释放
+    SHARED_JOB_SYNC_INTERVAL = 1.0  # 后台任务进度写入共享状态的最小间隔（秒）
+
+    # 后台任务
+    JOB_FILE_WORKERS = 4  # 单个任务同时处理的文件数
+    JOB_HISTORY = 100  # 保留的已结束任务数
+    JOB_EVENT_QUEUE_SIZE = 1000  # 每个进度订阅者的事件队列长度
+    JOB_HEARTBEAT_INTERVAL = 15.0  # 进度流心跳间隔（秒）
+
+    # 日志：LOG_FORMAT 为 json 时每行一条结构化日志，text 为普通文本
+    LOG_LEVEL = os.getenv("SUPERVISE_LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.getenv("SUPERVISE_LOG_FORMAT", "json")
@@ -16,3 +16,49 @@ class ClauseType(Enum):
 class AutoSupervision(Enum):
     NOT_AUTO_SUPERVISED = 0
     AUTO_SUPERVISED = 1
+
+
+class CacheMode(str, Enum):
+    USE = "use"  # 优先读取缓存
+    BYPASS = "bypass"  # 不读也不写缓存
+    REFRESH = "refresh"  # 忽略已有缓存，重新请求并写入
+
+
+class RuleChange(str, Enum):
+    UNCHANGED = "unchanged"  # 序号和内容都未变化
+    MOVED = "moved"  # 内容未变化，序号变化
+    CHANGED = "changed"  # 序号相同，内容变化
+    ADDED = "added"  # 新增的条例
+    REMOVED = "removed"  # 已删除的条例
+
+
+class Priority(str, Enum):
+    HIGH = "high"
+    NORMAL = "normal"
+    LOW = "low"
+
+
+class SpeculationMode(str, Enum):
+    OFF = "off"  # 按顺序调用
+    ON = "on"  # 总是同时发起有依赖的两个调用
+    AUTO = "auto"  # 观察到的命中率达到阈值时才同时发起
+
+
+class PostProcessStep(str, Enum):
+    MODIFY = "modify"  # 提取通用要素并生成 CDSRL
+    BEAUTIFY = "beautify"  # 美化 CDSRL 两列
+    COLUMN_WIDTH = "set_column_width"  # 设置最后两列列宽
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class ResultGroupBy(str, Enum):
+    CATEGORY = "category"  # 按监管类别统计
+    TYPE = "type"  # 按监管类型统计
+    SUPERVISE = "supervise"  # 按是否可自动监管统计
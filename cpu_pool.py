@@ -0,0 +1,48 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from config import Config
+from metrics import Gauge, registry
+
+_executor: Optional[Executor] = None
+_in_flight = 0
+
+
+def start_cpu_pool():
+    """
+    应用启动时创建共享进程池，CPU_WORKERS 为 0 时不创建，改用默认线程池。
+    多 worker 部署时每个 worker 各有一个进程池，未指定进程数时按 worker 数均分 CPU 核
+    """
+    global _executor
+    if _executor is None and Config.CPU_WORKERS != 0:
+        max_workers = Config.CPU_WORKERS
+        if max_workers is None and Config.WORKERS > 1:
+            max_workers = max(1, (os.cpu_count() or 1) // Config.WORKERS)
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+
+
+def shutdown_cpu_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def run_cpu(fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    在进程池中执行 openpyxl 等 CPU 密集的同步函数，避免阻塞事件循环。
+    fn 和参数需可 pickle（模块级函数或可 pickle 对象的方法）；
+    未启动进程池时（如脚本直接调用）退回到默认线程池
+    """
+    global _in_flight
+    _in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _in_flight -= 1
+
+
+registry.register(Gauge('cpu_pool_in_flight', 'Functions submitted to the CPU pool and not yet finished', (),
+                        lambda: {(): _in_flight}))
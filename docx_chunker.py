@@ -0,0 +1,96 @@
+import hashlib
+import io
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+from docx import Document
+from docx.table import Table
+
+# 条文以“第X条”开头，X 为中文或阿拉伯数字
+ARTICLE_PATTERN = re.compile(r'^\s*第[零〇一二三四五六七八九十百千两\d]+条')
+
+
+def read_paragraphs(file_path: str) -> List[str]:
+    """
+    按文档顺序读出非空段落，表格每行合并为一段
+    """
+    paragraphs = []
+    for block in Document(file_path).iter_inner_content():
+        if isinstance(block, Table):
+            texts = ['\t'.join(cell.text.strip() for cell in row.cells) for row in block.rows]
+        else:
+            texts = [block.text]
+        paragraphs.extend(text.strip() for text in texts if text.strip())
+    return paragraphs
+
+
+def split_articles(paragraphs: List[str]) -> List[List[str]]:
+    """
+    以“第X条”开头的段落为界切分条文；第一条之前的标题、章节名等单独成组，
+    条文之间的章节名归入下一条之前的那一组
+    """
+    articles: List[List[str]] = []
+    for paragraph in paragraphs:
+        if not articles or ARTICLE_PATTERN.match(paragraph):
+            articles.append([paragraph])
+        else:
+            articles[-1].append(paragraph)
+    return articles
+
+
+def pack_chunks(articles: List[List[str]], max_chars: int) -> List[List[str]]:
+    # 相邻条文合并到 max_chars 以内，条文不跨块拆分，超长的条文单独成块
+    chunks: List[List[str]] = []
+    size = 0
+    for article in articles:
+        article_size = sum(len(paragraph) for paragraph in article)
+        if chunks and size + article_size <= max_chars:
+            chunks[-1].extend(article)
+            size += article_size
+        else:
+            chunks.append(list(article))
+            size = article_size
+    return chunks
+
+
+def build_docx(paragraphs: List[str]) -> bytes:
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def chunk_digest(paragraphs: List[str]) -> str:
+    # 生成的 .docx 带有保存时间，字节每次都不同；按段落文本计算哈希，作为缓存和合并请求的键
+    return hashlib.sha256(json.dumps(["docx_chunk", paragraphs], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def split_document(file_path: str, max_chars: int) -> List[Tuple[str, bytes]]:
+    """
+    本地解析 .docx，按条文对齐切成若干个小 .docx，返回 (内容哈希, 文件内容)，在进程池中执行；
+    只有一块时返回空列表，调用方直接上传原文件
+    """
+    chunks = pack_chunks(split_articles(read_paragraphs(file_path)), max_chars)
+    if len(chunks) <= 1:
+        return []
+    return [(chunk_digest(chunk), build_docx(chunk)) for chunk in chunks]
+
+
+def merge_rule_lists(rule_lists: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    按块的顺序合并各块的条例列表。上游按块重新编号时 rule_order 会重复，
+    重复的加上块序号区分，合并结果与各块完成的先后无关
+    """
+    merged = []
+    seen = set()
+    for chunk_index, rule_list in enumerate(rule_lists, 1):
+        for rule in rule_list:
+            rule_order = rule['rule_order']
+            if rule_order in seen:
+                rule_order = f"{chunk_index}-{rule_order}"
+            seen.add(rule_order)
+            merged.append({**rule, 'rule_order': rule_order})
+    return merged
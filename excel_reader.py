@@ -0,0 +1,34 @@
+from typing import Any
+
+from openpyxl.reader.excel import load_workbook
+
+from constant import AutoSupervision
+
+AUTOMATABLE_COLUMN = 'Automatable_supervision'
+
+
+def is_auto_supervised(value: Any) -> bool:
+    """
+    gen_excel 以字符串写入 "1"，人工编辑过的文件可能是数字 1，两种都视为可自动监管
+    """
+    if isinstance(value, str):
+        value = value.strip()
+        return value == str(AutoSupervision.AUTO_SUPERVISED.value)
+    return value == AutoSupervision.AUTO_SUPERVISED.value
+
+
+def count_automatable(file_path: str) -> int:
+    """
+    以只读流式模式读取第一个工作表，只统计 Automatable_supervision 一列
+    """
+    workbook = load_workbook(file_path, read_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        header = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        if AUTOMATABLE_COLUMN not in header:
+            raise KeyError(AUTOMATABLE_COLUMN)
+        column = header.index(AUTOMATABLE_COLUMN) + 1
+        return sum(1 for (value,) in sheet.iter_rows(min_row=2, min_col=column, max_col=column, values_only=True)
+                   if is_auto_supervised(value))
+    finally:
+        workbook.close()
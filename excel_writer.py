@@ -0,0 +1,78 @@
+from typing import Any, List, Sequence
+
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
+from openpyxl.workbook import Workbook
+
+MAX_COLUMN_WIDTH = 40  # 最大列宽度
+MAX_ROW_HEIGHT = 60  # 最大行高度
+LINE_HEIGHT = 15  # 单行高度
+
+# 样式对象全局共享，避免每个单元格创建一次
+WRAP_ALIGNMENT = Alignment(wrap_text=True)
+CENTER_ALIGNMENT = Alignment(horizontal='center', vertical='center', wrap_text=True)
+
+
+class StreamingSheetWriter:
+    """
+    只写模式的工作表写入器：追加行时同步累计列宽和行高，最后一次性写出并保存。
+    openpyxl 只写模式要求列宽在第一行数据之前写出，因此这里只缓存单元格的值，不创建单元格对象
+    """
+
+    def __init__(self, headers: Sequence[str], max_column_width: int = MAX_COLUMN_WIDTH,
+                 max_row_height: int = MAX_ROW_HEIGHT):
+        self.max_column_width = max_column_width
+        self.max_row_height = max_row_height
+        self.rows: List[Sequence[Any]] = []
+        self.heights: List[int] = []
+        self.widths: List[int] = []
+        self.merged: List[CellRange] = []
+        self.merge_anchors = set()
+        self.append(headers)
+
+    @property
+    def max_row(self) -> int:
+        return len(self.rows)
+
+    def append(self, row: Sequence[Any]):
+        height = LINE_HEIGHT
+        for index, value in enumerate(row):
+            text = '' if value is None else str(value)
+            if index >= len(self.widths):
+                self.widths.append(0)
+            self.widths[index] = max(self.widths[index], len(text))
+            height = max(height, LINE_HEIGHT * (text.count('\n') + 1))
+        self.rows.append(row)
+        self.heights.append(min(height, self.max_row_height))
+
+    def merge(self, start_row: int, end_row: int, columns: Sequence[int]):
+        for column in columns:
+            self.merged.append(CellRange(min_col=column, min_row=start_row, max_col=column, max_row=end_row))
+            self.merge_anchors.add((start_row, column))
+
+    def save(self, file_path: str):
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+
+        # 自适应列宽，不超过最大宽度
+        for index, width in enumerate(self.widths, start=1):
+            sheet.column_dimensions[get_column_letter(index)].width = min(width, self.max_column_width) + 5
+
+        for row_index, (row, height) in enumerate(zip(self.rows, self.heights), start=1):
+            sheet.row_dimensions[row_index].height = height
+            cells = []
+            for column_index, value in enumerate(row, start=1):
+                cell = WriteOnlyCell(sheet, value=None if value == '' else value)
+                if (row_index, column_index) in self.merge_anchors:
+                    cell.alignment = CENTER_ALIGNMENT
+                else:
+                    cell.alignment = WRAP_ALIGNMENT
+                cells.append(cell)
+            sheet.append(cells)
+
+        # 合并区域互不重叠，直接整体设置；MultiCellRange.add 每次都会检查与已有区域的包含关系，行数多时是平方复杂度
+        sheet.merged_cells = MultiCellRange(self.merged)
+
+        workbook.save(file_path)
@@ -0,0 +1,83 @@
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from constant import RuleChange
+from model import RuleObject
+
+# 上一次处理结果中的一条条例及其各原子条例的结果行
+PreviousRule = Tuple[RuleObject, List[List[Any]]]
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(str(content).strip().encode('utf-8')).hexdigest()
+
+
+def group_previous(excel_list: List[RuleObject], rows: List[List[Any]]) -> List[PreviousRule]:
+    # 结果库中的行按原子条例顺序排列，按每条条例的原子条例数切分
+    results = iter(rows)
+    return [(rule_group, [next(results) for _ in rule_group.atom_rules]) for rule_group in excel_list]
+
+
+def plan_changes(rule_list: List[Dict[str, Any]], previous: List[PreviousRule]) \
+        -> Tuple[List[Optional[PreviousRule]], Dict[str, Any]]:
+    """
+    把新文档的条例与上一次的结果比对，返回与 rule_list 一一对应的可沿用结果（需要重新处理的为 None）和变更报告。
+    rule_order 与内容都相同为 unchanged；内容相同、序号变化为 moved；序号相同、内容变化为 changed；
+    其余为 added，上一次有、这一次没有匹配上的为 removed
+    """
+    by_key: Dict[Tuple[str, str], List[int]] = {}
+    by_hash: Dict[str, List[int]] = {}
+    by_order = set()
+    for index, (rule_group, _) in enumerate(previous):
+        digest = content_hash(rule_group.rule_content)
+        by_key.setdefault((rule_group.rule_order, digest), []).append(index)
+        by_hash.setdefault(digest, []).append(index)
+        by_order.add(rule_group.rule_order)
+
+    used = set()
+
+    def take(candidates: List[int]) -> Optional[int]:
+        for candidate in candidates:
+            if candidate not in used:
+                used.add(candidate)
+                return candidate
+        return None
+
+    # 先匹配序号和内容都相同的，再匹配只有内容相同的，最后按序号判断修改，避免移动的条例被误判为修改
+    digests = [content_hash(rule['rule_content']) for rule in rule_list]
+    matches: List[Optional[int]] = [take(by_key.get((rule['rule_order'], digest), []))
+                                    for rule, digest in zip(rule_list, digests)]
+    changes = [RuleChange.UNCHANGED if matched is not None else None for matched in matches]
+    for position, digest in enumerate(digests):
+        if matches[position] is None:
+            matches[position] = take(by_hash.get(digest, []))
+            if matches[position] is not None:
+                changes[position] = RuleChange.MOVED
+    for position, rule in enumerate(rule_list):
+        if matches[position] is None:
+            changes[position] = RuleChange.CHANGED if rule['rule_order'] in by_order else RuleChange.ADDED
+    # 被修改的条例的旧内容不再算作删除
+    changed_orders = {rule['rule_order'] for rule, change in zip(rule_list, changes) if change == RuleChange.CHANGED}
+
+    carried: List[Optional[PreviousRule]] = []
+    report: Dict[str, Any] = {change.value: [] for change in RuleChange}
+    for rule, matched, change in zip(rule_list, matches, changes):
+        rule_order = rule['rule_order']
+        if matched is None:
+            carried.append(None)
+            report[change.value].append(rule_order)
+            continue
+        rule_group, rows = previous[matched]
+        carried.append((RuleObject(rule_order=rule_order, rule_content=rule['rule_content'],
+                                   atom=rule_group.atom, atom_rules=list(rule_group.atom_rules)),
+                        [list(row) for row in rows]))
+        if change == RuleChange.MOVED:
+            report[change.value].append({"rule_order": rule_order, "previous_rule_order": rule_group.rule_order})
+        else:
+            report[change.value].append(rule_order)
+
+    report[RuleChange.REMOVED.value] = [rule_group.rule_order for index, (rule_group, _) in enumerate(previous)
+                                        if index not in used and rule_group.rule_order not in changed_orders]
+    # 没有变化的条例数量可能很大，只返回数量
+    report[RuleChange.UNCHANGED.value] = len(report[RuleChange.UNCHANGED.value])
+    return carried, report
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from config import Config
+from constant import JobStatus
+from metrics import Gauge, registry
+from shared_state import SharedState, get_shared_state
+
+FINISHED_STATUSES = {JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED}
+
+# 当前正在执行的任务和文件，条例处理过程中据此上报进度
+current_job: ContextVar[Optional["Job"]] = ContextVar("current_job", default=None)
+current_file: ContextVar[Optional[str]] = ContextVar("current_file", default=None)
+
+
+class Job:
+    def __init__(self, kind: str, params: Dict[str, Any], files: List[str]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = JobStatus.PENDING
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.files: Dict[str, str] = {file: JobStatus.PENDING.value for file in files}
+        self.results: List[Any] = []
+        self.error: Optional[str] = None
+        self.total_rules = 0
+        self.done_rules = 0
+        self.task: Optional[asyncio.Task] = None
+        self._subscribers: List[asyncio.Queue] = []
+        self._published_at = 0.0
+
+    @property
+    def done_files(self) -> int:
+        return sum(1 for status in self.files.values() if status in (JobStatus.COMPLETED, JobStatus.FAILED))
+
+    def emit(self, event: str, **data):
+        message = {"event": event, "job_id": self.id, "time": time.time(), **data}
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 客户端消费过慢时丢弃进度事件，状态以快照为准
+                pass
+        self.publish(force=event != "rule")
+
+    def publish(self, force: bool = True):
+        """
+        多 worker 部署时把快照写入共享状态，其他 worker 据此查询进度；条例进度按间隔节流
+        """
+        shared = get_shared_state()
+        if shared is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._published_at < Config.SHARED_JOB_SYNC_INTERVAL:
+            return
+        self._published_at = now
+        shared.save_job(self.id, self.status.value, self.snapshot(), self.created_at)
+
+    def set_status(self, status: JobStatus, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        if status == JobStatus.RUNNING:
+            self.started_at = time.time()
+        elif status in FINISHED_STATUSES:
+            self.finished_at = time.time()
+        self.emit("status", **self.snapshot())
+
+    def set_file_status(self, file: str, status: JobStatus, **data):
+        self.files[file] = status.value
+        self.emit("file", file=file, status=status.value, **data)
+
+    def add_rules(self, count: int):
+        self.total_rules += count
+
+    def advance_rules(self, count: int = 1, **data):
+        self.done_rules += count
+        self.emit("rule", done_rules=self.done_rules, total_rules=self.total_rules, **data)
+
+    def snapshot(self):
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        done_files = self.done_files
+        remaining_files = len(self.files) - done_files
+        eta = None
+        if self.status == JobStatus.RUNNING:
+            if self.total_rules and self.done_rules:
+                eta = elapsed / self.done_rules * (self.total_rules - self.done_rules)
+            elif done_files:
+                eta = elapsed / done_files * remaining_files
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status.value,
+            "params": self.params,
+            "created_at": self.created_at,
+            "elapsed": round(elapsed, 3),
+            "total_files": len(self.files),
+            "done_files": done_files,
+            "files": self.files,
+            "total_rules": self.total_rules,
+            "done_rules": self.done_rules,
+            "files_per_minute": round(done_files / elapsed * 60, 3) if elapsed else 0.0,
+            "rules_per_second": round(self.done_rules / elapsed, 3) if elapsed else 0.0,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "error": self.error,
+            "results": self.results if self.status in FINISHED_STATUSES else None,
+        }
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=Config.JOB_EVENT_QUEUE_SIZE)
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+
+class JobManager:
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+
+    def submit(self, kind: str, params: Dict[str, Any], files: List[str],
+               process_file: Callable[[str], Awaitable[Any]]) -> Job:
+        """
+        提交任务后立即返回，后台按 Config.JOB_FILE_WORKERS 的并发度逐个处理文件
+        """
+        job = Job(kind, params, files)
+        self.jobs[job.id] = job
+        self._prune()
+        job.publish()
+        job.task = asyncio.create_task(self._run(job, process_file))
+        job.task.add_done_callback(lambda task: self._on_done(job, task))
+        return job
+
+    @staticmethod
+    def _on_done(job: Job, task: asyncio.Task):
+        # 任务在开始执行前被取消时不会进入 _run 的异常处理
+        if task.cancelled() and job.status not in FINISHED_STATUSES:
+            job.set_status(JobStatus.CANCELLED)
+
+    async def _run(self, job: Job, process_file: Callable[[str], Awaitable[Any]]):
+        current_job.set(job)
+        job.set_status(JobStatus.RUNNING)
+        shared = get_shared_state()
+        watcher = asyncio.create_task(self._watch_cancel(job, shared)) if shared is not None else None
+        semaphore = asyncio.Semaphore(Config.JOB_FILE_WORKERS)
+
+        async def run_file(file: str):
+            async with semaphore:
+                current_file.set(file)
+                job.set_file_status(file, JobStatus.RUNNING)
+                try:
+                    result = await process_file(file)
+                except asyncio.CancelledError:
+                    job.set_file_status(file, JobStatus.CANCELLED)
+                    raise
+                except Exception as e:
+                    job.set_file_status(file, JobStatus.FAILED, error=str(e))
+                    return {"file": file, "status": "Failed", "error": str(e)}
+                # 处理函数以返回值报告失败（如读取、保存失败）时同样记为失败
+                if isinstance(result, dict) and str(result.get("status", "")).startswith("Failed"):
+                    job.set_file_status(file, JobStatus.FAILED, error=result.get("error", result["status"]))
+                    return result
+                job.set_file_status(file, JobStatus.COMPLETED)
+                return result
+
+        try:
+            job.results = list(await asyncio.gather(*(run_file(file) for file in job.files)))
+        except asyncio.CancelledError:
+            job.set_status(JobStatus.CANCELLED)
+            return
+        except Exception as e:
+            job.set_status(JobStatus.FAILED, error=str(e))
+            return
+        else:
+            job.set_status(JobStatus.COMPLETED)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+    @staticmethod
+    async def _watch_cancel(job: Job, shared: SharedState):
+        # 取消请求可能由其他 worker 收到，执行任务的 worker 轮询共享状态
+        while True:
+            await asyncio.sleep(Config.SHARED_JOB_SYNC_INTERVAL)
+            if shared.cancel_requested(job.id):
+                job.task.cancel()
+                return
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def snapshot(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        本 worker 的任务返回实时快照，其他 worker 的任务从共享状态读取
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        shared = get_shared_state()
+        return shared.load_job(job_id) if shared is not None else None
+
+    def snapshots(self) -> List[Dict[str, Any]]:
+        snapshots = {job.id: job.snapshot() for job in self.jobs.values()}
+        shared = get_shared_state()
+        if shared is not None:
+            for snapshot in shared.jobs():
+                snapshots.setdefault(snapshot["job_id"], snapshot)
+        return sorted(snapshots.values(), key=lambda snapshot: snapshot["created_at"])
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+            return job.snapshot()
+        # 任务由其他 worker 执行时记下取消请求
+        shared = get_shared_state()
+        if shared is not None and shared.request_cancel(job_id):
+            return shared.load_job(job_id)
+        return None
+
+    def _prune(self):
+        # 只保留最近 Config.JOB_HISTORY 个已结束的任务
+        finished = [job for job in self.jobs.values() if job.status in FINISHED_STATUSES]
+        for job in sorted(finished, key=lambda job: job.created_at)[:-Config.JOB_HISTORY or None]:
+            del self.jobs[job.id]
+        shared = get_shared_state()
+        if shared is not None:
+            shared.prune_jobs([status.value for status in FINISHED_STATUSES], Config.JOB_HISTORY)
+
+    async def events(self, job: Job) -> AsyncIterator[str]:
+        """
+        Server-Sent Events 流：先推送当前快照，再推送实时进度，任务结束后关闭
+        """
+        queue = job.subscribe()
+        try:
+            yield format_event("status", job.snapshot())
+            while job.status not in FINISHED_STATUSES:
+                try:
+                    message = await asyncio.wait_for(queue.get(), Config.JOB_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(message["event"], message)
+            yield format_event("end", job.snapshot())
+        finally:
+            job.unsubscribe(queue)
+
+    @staticmethod
+    async def remote_events(job_id: str) -> AsyncIterator[str]:
+        """
+        任务由其他 worker 执行时轮询共享状态中的快照，有变化时推送
+        """
+        shared = get_shared_state()
+        last = None
+        sent_at = time.monotonic()
+        while True:
+            snapshot = shared.load_job(job_id)
+            if snapshot is None:
+                return
+            if JobStatus(snapshot["status"]) in FINISHED_STATUSES:
+                yield format_event("end", snapshot)
+                return
+            if snapshot != last:
+                last = snapshot
+                sent_at = time.monotonic()
+                yield format_event("status", snapshot)
+            elif time.monotonic() - sent_at >= Config.JOB_HEARTBEAT_INTERVAL:
+                sent_at = time.monotonic()
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(Config.SHARED_JOB_SYNC_INTERVAL)
+
+
+def format_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def add_rules(count: int):
+    job = current_job.get()
+    if job is not None:
+        job.add_rules(count)
+
+
+def advance_rules(count: int = 1, **data):
+    job = current_job.get()
+    if job is not None:
+        job.advance_rules(count, file=current_file.get(), **data)
+
+
+job_manager = JobManager()
+
+
+def _job_counts():
+    counts = {(status.value,): 0 for status in JobStatus}
+    for job in job_manager.jobs.values():
+        counts[(job.status.value,)] += 1
+    return counts
+
+
+registry.register(Gauge('jobs', 'Background jobs by status', ('status',), _job_counts))
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+from cache import cache_mode
+from constant import CacheMode
+
+JOURNAL_FILE_NAME = '.journal.jsonl'
+UPLOAD_PHASE = 'upload_file'
+
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    跨进程的排他锁，锁住 path 旁边的 .lock 文件；多个 worker 写同一目标文件夹的日志时使用
+    """
+    with open(path + '.lock', 'a+b') as lock_file:
+        if os.name == 'nt':
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def record_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+class Journal:
+    """
+    批处理日志，追加写入 JSONL：
+    {"type": "file", ...} 记录已完成的文件，{"type": "rule", ...} 记录未完成文件中已完成的条例，
+    进程中断后重新运行时跳过已完成的文件并复用已完成的条例结果。
+    多个 worker 可能同时写同一个日志：载入与压缩、每次追加、每次查询都持有跨进程文件锁，
+    查询前读入其他 worker 新追加的记录；追加时按路径重新打开文件，压缩替换文件后不会写进旧文件
+    """
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, JOURNAL_FILE_NAME)
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        # 已读到的文件位置，以及读取的是哪个文件（其他 worker 压缩后文件会被替换）
+        self._offset = 0
+        self._inode: Optional[int] = None
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with file_lock(self.path):
+            self._read()
+            self._compact()
+
+    def _read(self):
+        # 从上次读到的位置读入新追加的记录；文件被替换或变短时从头读取
+        if not os.path.exists(self.path):
+            return
+        stat = os.stat(self.path)
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self.files.clear()
+            self.rules.clear()
+            self._offset = 0
+            self._inode = stat.st_ino
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    # 进程中断时最后一行可能不完整
+                    break
+                self._offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') == 'file':
+                    self.files[record['phase'] + '\n' + record['file']] = record
+                    self.rules.pop(record['phase'] + '\n' + record['file'], None)
+                elif record.get('type') == 'rule':
+                    self.rules.setdefault(record['phase'] + '\n' + record['file'], {})[record['key']] = record['result']
+
+    def _refresh(self):
+        with file_lock(self.path):
+            self._read()
+
+    def _compact(self):
+        # 已完成文件的条例记录不再需要，重写日志只保留有效记录
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for record in self.files.values():
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            for file_key, results in self.rules.items():
+                phase, name = file_key.split('\n', 1)
+                for key, result in results.items():
+                    file.write(json.dumps({"type": "rule", "phase": phase, "file": name, "key": key,
+                                           "result": result}, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+        stat = os.stat(self.path)
+        self._offset = stat.st_size
+        self._inode = stat.st_ino
+
+    def _append(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with file_lock(self.path):
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line)
+
+    def is_file_done(self, phase: str, file: str, source_hash: str, output: Optional[str] = None) -> bool:
+        self._refresh()
+        record = self.files.get(phase + '\n' + file)
+        if record is None or record['source_hash'] != source_hash:
+            return False
+        return output is None or os.path.exists(output)
+
+    def file_done(self, phase: str, file: str, source_hash: str, output: Optional[str] = None):
+        record = {"type": "file", "phase": phase, "file": file, "source_hash": source_hash, "output": output}
+        self.files[phase + '\n' + file] = record
+        self.rules.pop(phase + '\n' + file, None)
+        self._append(record)
+
+    def get(self, phase: str, file: str, key: str) -> Optional[Any]:
+        self._refresh()
+        return self.rules.get(phase + '\n' + file, {}).get(key)
+
+    def put(self, phase: str, file: str, key: str, result: Any):
+        self.rules.setdefault(phase + '\n' + file, {})[key] = result
+        self._append({"type": "rule", "phase": phase, "file": file, "key": key, "result": result})
+
+    def for_file(self, phase: str, file: str, resume: bool = True) -> "FileJournal":
+        return FileJournal(self, phase, file, resume)
+
+
+class FileJournal:
+    def __init__(self, journal: Journal, phase: str, file: str, resume: bool = True):
+        self.journal = journal
+        self.phase = phase
+        self.file = file
+        # 不续跑时只复用本次运行中写入的结果，不读取日志中已有的记录
+        self.local: Optional[Dict[str, Any]] = None if resume else {}
+
+    def get(self, *parts: Any) -> Optional[Any]:
+        key = record_key(*parts)
+        if self.local is not None:
+            return self.local.get(key)
+        return self.journal.get(self.phase, self.file, key)
+
+    def put(self, result: Any, *parts: Any):
+        key = record_key(*parts)
+        if self.local is not None:
+            self.local[key] = result
+        self.journal.put(self.phase, self.file, key, result)
+
+
+_journals: Dict[str, Journal] = {}
+
+# 当前请求使用的批处理日志、是否断点续跑，以及当前文件的日志视图
+current_journal: ContextVar[Optional[Journal]] = ContextVar("current_journal", default=None)
+journal_resume: ContextVar[bool] = ContextVar("journal_resume", default=True)
+file_journal: ContextVar[Optional[FileJournal]] = ContextVar("file_journal", default=None)
+
+
+def open_journal(folder: str) -> Journal:
+    folder = os.path.abspath(folder)
+    journal = _journals.get(folder)
+    if journal is None:
+        journal = _journals[folder] = Journal(folder)
+    return journal
+
+
+def use_journal(folder: str, resume: bool = True):
+    """
+    为当前请求启用批处理日志，resume 为 False 时只记录不复用；
+    需在设置 cache_mode 之后调用，缓存模式不是 use（refresh / bypass）时同样不复用日志中的结果
+    """
+    current_journal.set(open_journal(folder))
+    journal_resume.set(resume and cache_mode.get() == CacheMode.USE)
+
+
+def close_journals():
+    # 追加时才打开日志文件，没有需要关闭的句柄
+    _journals.clear()
+
+
+def journal_get(*parts: Any) -> Optional[Any]:
+    journal = file_journal.get()
+    return journal.get(*parts) if journal is not None else None
+
+
+def journal_put(result: Any, *parts: Any):
+    journal = file_journal.get()
+    if journal is not None:
+        journal.put(result, *parts)
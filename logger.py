@@ -0,0 +1,75 @@
+import json
+import logging
+import sys
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from config import Config
+from jobs import current_file, current_job
+
+# 当前处理的条例（rule_order、行号等），与任务、文件一起写入每条日志
+current_rule: ContextVar[Optional[str]] = ContextVar("current_rule", default=None)
+
+LOGGER_NAME = 'supervise_gpt'
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        job = current_job.get()
+        record.job_id = job.id if job is not None else None
+        record.file = current_file.get()
+        record.rule_id = current_rule.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出一行 JSON，extra={"fields": {...}} 中的字段会并入日志
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "job_id": getattr(record, 'job_id', None),
+            "file": getattr(record, 'file', None),
+            "rule_id": getattr(record, 'rule_id', None),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        context = ' '.join(f"{name}={value}" for name in ('job_id', 'file', 'rule_id')
+                           if (value := getattr(record, name, None)) is not None)
+        fields = ' '.join(f"{name}={value}" for name, value in getattr(record, 'fields', {}).items())
+        message = ' '.join(part for part in (super().format(record), context, fields) if part)
+        return message
+
+
+def _configure() -> logging.Logger:
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.addFilter(ContextFilter())
+        if Config.LOG_FORMAT == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(Config.LOG_LEVEL)
+        logger.propagate = False
+    return logger
+
+
+_configure()
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
@@ -1,362 +1,587 @@
-import json
+import io
 import os
-from io import BytesIO
-from typing import List
+import tempfile
+import time
+from contextlib import asynccontextmanager, nullcontext
+from typing import List, Optional
 
-import pandas as pd
 import uvicorn
-from fastapi import FastAPI
-from openpyxl.reader.excel import load_workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
-from openpyxl.workbook import Workbook
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 from api import *
+from api_requests import APIRequest
+from cache import cache_mode, close_cache, get_cache
 from constant import *
-from model import RuleObject
-
-app = FastAPI()
-
-
-@app.post('/upload_file')
-async def process(origin_folder: str, target_folder: str):
-    # 创建一个任务列表
-    tasks = []
-
-    # 遍历源文件夹中的所有文件
-    for filename in os.listdir(origin_folder):
-        file_path = os.path.join(origin_folder, filename)
-
-        # 检查是否为文件而非目录
-        if os.path.isfile(file_path):
-            # 以二进制模式打开文件
-            with open(file_path, 'rb') as file:
-                file_content = file.read()
-                # 模拟一个 UploadFile 对象
-                file_like = UploadFile(filename=filename, file=BytesIO(file_content))
-
-                rule_result = await upload_file(file_like)
-
-                rule = rule_result.get('ruleList', [])
-
-                # 创建任务并添加到任务列表
-                task = asyncio.create_task(process_single_file(filename, rule, target_folder))
-
-                tasks.append(task)
-        # 并发执行所有任务
-    await asyncio.gather(*tasks)
-
-    return {"message": "All files have been processed."}
+from cpu_pool import run_cpu, shutdown_cpu_pool, start_cpu_pool
+from docx_chunker import merge_rule_lists, split_document
+from excel_reader import count_automatable, is_auto_supervised
+from excel_writer import StreamingSheetWriter
+from incremental import PreviousRule, group_previous, plan_changes
+from jobs import add_rules, advance_rules, current_file, job_manager
+from journal import (UPLOAD_PHASE, close_journals, current_journal, file_hash, file_journal, journal_get,
+                     journal_put, journal_resume, use_journal)
+from logger import current_rule, get_logger
+from metrics import WORKBOOK_DURATION, registry
+from model import RuleObject, SuperViseGroup
+from rate_limiter import limiter_stats
+from results_store import close_results_store, get_results_store
+from retry_policy import retry_policy, set_job_deadline
+from scheduler import scheduler_stats, set_flow
+from shared_state import close_shared_state
+from similarity import close_similarity_index, get_similarity_index, reuse_report, reuse_similar
+from speculation import run_dependent, speculation_stats
+from transforms import (BeautifyTransform, ColumnWidthTransform, EnrichTransform, apply_transforms,
+                        build_transforms, enrich_rule, is_enriched)
+
+logger = get_logger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # 应用启动时创建共享的 HTTP 客户端和工作簿处理进程池，关闭时释放
+    await APIRequest.startup()
+    start_cpu_pool()
+    yield
+    await APIRequest.shutdown()
+    shutdown_cpu_pool()
+    close_cache()
+    close_journals()
+    close_results_store()
+    close_similarity_index()
+    close_shared_state()
+
+
+async def scheduling(request: Request, priority: Priority = Priority.NORMAL, client: Optional[str] = None):
+    """
+    上游调用按调用方公平排队：client 未指定时按客户端地址区分，后台任务按任务 ID 区分；
+    只挂在会请求上游的接口上
+    """
+    set_flow(client or (request.client.host if request.client else None), priority)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post('/upload_file', dependencies=[Depends(scheduling)])
+async def process(origin_folder: str, target_folder: str, cache: CacheMode = CacheMode.USE,
+                  deadline: Optional[float] = None, resume: bool = True, skip_up_to_date: bool = False,
+                  fused: bool = False, chunked: bool = False, incremental: bool = False):
+    """
+    fused 为 True 时每条条例一路处理到 CDSRL，直接输出补充后的工作簿，无需再调用 /modify；
+    chunked 为 True 时大文档按条文切块并发提取条例；
+    incremental 为 True 时与结果库中上一次的结果比对，只处理新增、修改的条例
+    """
+    cache_mode.set(cache)
+    set_job_deadline(deadline)
+    use_journal(target_folder, resume)
+    # 同时上传的文件数有上限，每个文件拿到条例列表后立即开始处理，不等待其他文件上传
+    upload_slots = asyncio.Semaphore(Config.UPLOAD_CONCURRENCY)
+
+    async def run(file_path: str):
+        try:
+            return await upload_and_process(file_path, target_folder, skip_up_to_date, upload_slots, fused, chunked,
+                                            incremental)
+        except Exception as e:
+            logger.error("failed to process document", extra={"fields": {"file": file_path, "error": str(e)}})
+            return {"file": file_path, "status": "Failed", "error": str(e)}
+
+    results = await asyncio.gather(*(run(file_path) for file_path in list_source_files(origin_folder)))
+    return {"message": "All files have been processed.", "results": results}
+
+
+HEADERS = ["rule_order", "rule_content", "atom", "atom_rule_content", "Automatable_supervision", "category", "type"]
+ENRICH_HEADERS = ["common_element", "CDSRL_result"]
+
+
+async def atomize_rule(result) -> RuleObject:
+    rule_order = result['rule_order']
+    rule_content = result['rule_content']
+    current_rule.set(rule_order)
+
+    # 断点续跑：复用上次已完成的结果
+    journaled = journal_get('atomize', rule_order, rule_content)
+    if journaled is not None:
+        advance_rules(stage="atomize", rule_order=rule_order)
+        return RuleObject(**journaled)
+
+    # 如果是复杂条例，拆分为原子条例，否则将原始条例作为单个原子条例；投机模式下判断与拆分同时发起
+    check_atom_rule_result, split_rules_result = await run_dependent(
+        'check_split', lambda: check_atom_rule(rule_content), lambda: split_atomic_rules(rule_content),
+        lambda result: result['data'] == ClauseType.COMPLEX_CLAUSE.value)
+
+    if split_rules_result is not None:
+        atom_rules = [rule['atom_rule'] for rule in split_rules_result['ruleList']]
+    else:
+        atom_rules = [rule_content]
+
+    advance_rules(stage="atomize", rule_order=rule_order)
+
+    # 创建 RuleObject 实例
+    rule_obj = RuleObject(
+        rule_order=rule_order,
+        rule_content=rule_content,
+        atom=str(check_atom_rule_result['data']),
+        atom_rules=atom_rules
+    )
+    journal_put(rule_obj.model_dump(), 'atomize', rule_order, rule_content)
+    return rule_obj
+
+
+def classification_failed(supervise, category) -> bool:
+    return is_auto_supervised(supervise) and not category
+
+
+def row_failed(row: List, fused: bool = False) -> bool:
+    """
+    结果行中有上游失败的结果：可自动监管但没有类别，融合流水线中 common_element、CDSRL_result 为空或为错误信息
+    """
+    if classification_failed(row[0], row[1]):
+        return True
+    return fused and is_auto_supervised(row[0]) and not (is_enriched(row[3]) and is_enriched(row[4]))
+
+
+async def classify_atom_rule(rule_group: RuleObject, index: int, atom_rule: str) -> SuperViseGroup:
+    current_rule.set(f"{rule_group.rule_order}#{index}")
+    journaled = journal_get('classify', rule_group.rule_order, index, atom_rule)
+    if journaled is not None:
+        super_vise_group = SuperViseGroup(**journaled)
+    else:
+        super_vise_group = await process_rule(atom_rule)
+        # 分类请求失败时类别为空，不记入日志，下次重新请求
+        if not classification_failed(super_vise_group.supervise, super_vise_group.supervise_category):
+            journal_put(super_vise_group.model_dump(), 'classify', rule_group.rule_order, index, atom_rule)
+    advance_rules(stage="classify", rule_order=rule_group.rule_order)
+    return super_vise_group
 
 
 async def get_content(rule_list):
-    excel_list = []
-
-    for result in rule_list:
-        rule_order = result['rule_order']
-        rule_content = result['rule_content']
-        check_atom_rule_result = await check_atom_rule(rule_content)
+    add_rules(len(rule_list))
+    # 并发处理条例，结果保持原有顺序
+    return await gather_with_concurrency(Config.RULE_CONCURRENCY,
+                                         [atomize_rule(result) for result in rule_list], stage="atomize")
 
-        # 如果是复杂条例，拆分为原子条例，否则将原始条例作为单个原子条例
-        if check_atom_rule_result['data'] == ClauseType.COMPLEX_CLAUSE.value:
-            split_rules_result = await split_atomic_rules(rule_content)
-            atom_rules = [rule['atom_rule'] for rule in split_rules_result['ruleList']]
-        else:
-            atom_rules = [rule_content]
 
-        # 创建 RuleObject 实例并添加到列表中
-        rule_obj = RuleObject(
-            rule_order=rule_order,
-            rule_content=rule_content,
-            atom=str(check_atom_rule_result['data']),
-            atom_rules=atom_rules
-        )
-        excel_list.append(rule_obj)
-
-    return excel_list
+async def classify_rows(excel_list: List[RuleObject]) -> List[List]:
+    # 所有原子条例并发识别，结果按原有顺序排列，保证写入顺序与 rule_order 一致
+    add_rules(sum(len(rule_group.atom_rules) for rule_group in excel_list))
+    super_vise_groups = await gather_with_concurrency(
+        Config.RULE_CONCURRENCY,
+        [classify_atom_rule(rule_group, index, atom_rule) for rule_group in excel_list
+         for index, atom_rule in enumerate(rule_group.atom_rules)], stage="classify")
+    return [[group.supervise, group.supervise_category, group.supervise_type] for group in super_vise_groups]
 
 
 async def gen_excel(file_name: str, excel_list: List[RuleObject], target_folder: str):
-    workbook = Workbook()
-    sheet = workbook.active
-
-    headers = ["rule_order", "rule_content", "atom", "atom_rule_content", "Automatable_supervision", "category", "type"]
-    sheet.append(headers)
-
-    max_column_width = 40  # 最大列宽度
-    max_row_height = 60  # 最大行高度
+    rows = await classify_rows(excel_list)
+    await save_excel(file_name, target_folder, HEADERS, excel_list, rows)
+    return rows
+
+
+async def enrich_atom_rule(rule_group: RuleObject, index: int, atom_rule: str, category: str) -> List[str]:
+    add_rules(1)
+    enriched = await enrich_rule(atom_rule, category, ('enrich', rule_group.rule_order, index, atom_rule, category))
+    advance_rules(stage="enrich", rule_order=rule_group.rule_order)
+    return list(enriched)
+
+
+async def pipeline_rules(rule_list: List):
+    """
+    融合流水线：每条条例拆分完成后立即识别、分类，可自动监管的原子条例接着提取要素、生成 CDSRL，
+    返回 (excel_list, rows)，rows 带 common_element、CDSRL_result 两列
+    """
+    add_rules(len(rule_list))
+
+    async def process_atom_rule(rule_group: RuleObject, index: int, atom_rule: str):
+        group = await classify_atom_rule(rule_group, index, atom_rule)
+        row = [group.supervise, group.supervise_category, group.supervise_type]
+        if not is_auto_supervised(group.supervise):
+            return row + ['', '']
+        return row + await enrich_atom_rule(rule_group, index, atom_rule, group.supervise_category)
+
+    async def process_rule_group(result):
+        rule_group = await atomize_rule(result)
+        add_rules(len(rule_group.atom_rules))
+        rows = await asyncio.gather(*(process_atom_rule(rule_group, index, atom_rule)
+                                      for index, atom_rule in enumerate(rule_group.atom_rules)))
+        return rule_group, rows
+
+    # 并发数按条例计，每条条例的原子条例同时进入后续阶段，上游请求量由各接口的限流控制
+    results = await gather_with_concurrency(Config.RULE_CONCURRENCY,
+                                            [process_rule_group(result) for result in rule_list], stage="pipeline")
+    excel_list = [rule_group for rule_group, _ in results]
+    rows = [row for _, rows in results for row in rows]
+    return excel_list, rows
+
+
+async def run_pipeline(file_name: str, rule_list: List, target_folder: str):
+    # 不经过中间的 xlsx，最后写出一次带 common_element、CDSRL_result 两列的工作簿
+    excel_list, rows = await pipeline_rules(rule_list)
+    await save_excel(file_name, target_folder, HEADERS + ENRICH_HEADERS, excel_list, rows)
+    return excel_list, rows
+
+
+def find_previous(source_path: str, file_name: str) -> Optional[List[PreviousRule]]:
+    """
+    结果库中同一文档上一次的处理结果：优先按源文件路径，其次按文件名（修订版另存为新文件夹时）
+    """
+    store = get_results_store()
+    if store is None:
+        return None
+    found = store.find_document(source_path) or store.find_document(file_name)
+    if found is None:
+        return None
+    return group_previous(*store.load_document(found["id"]))
+
+
+async def run_incremental(file_name: str, rule_list: List, target_folder: str, previous: List[PreviousRule],
+                          fused: bool = False):
+    """
+    增量处理修订后的文档：与上一次的结果按 rule_order 和内容哈希比对，只有新增、修改的条例请求上游，
+    未变化的条例沿用上一次的拆分、分类和 CDSRL 结果，返回 (excel_list, rows, 变更报告)
+    """
+    carried, changes = plan_changes(rule_list, previous)
+    pending = [rule for rule, entry in zip(rule_list, carried) if entry is None]
+    # 新增、修改的条例不复用近似条例的结果，否则修改前的分类会被沿用
+    token = reuse_similar.set(False)
+    try:
+        if fused:
+            processed_list, processed_rows = await pipeline_rules(pending)
+        else:
+            processed_list = await get_content(pending)
+            processed_rows = await classify_rows(processed_list)
+    finally:
+        reuse_similar.reset(token)
+    changes["processed"] = len(pending)
+    if fused:
+        # 沿用的结果还没有 CDSRL 时（上一次不是融合流水线）只补充这一步
+        missing = [(row, enrich_atom_rule(rule_group, index, atom_rule, row[1]))
+                   for rule_group, carried_rows in filter(None, carried)
+                   for index, (atom_rule, row) in enumerate(zip(rule_group.atom_rules, carried_rows))
+                   if is_auto_supervised(row[0]) and not is_enriched(row[4])]
+        enriched = await gather_with_concurrency(Config.RULE_CONCURRENCY, [task for _, task in missing],
+                                                 stage="enrich")
+        for (row, _), values in zip(missing, enriched):
+            row[3:5] = values
+
+    processed = iter(processed_list)
+    processed_results = iter(processed_rows)
+    excel_list = []
+    rows = []
+    for entry in carried:
+        if entry is None:
+            rule_group = next(processed)
+            rows.extend(list(next(processed_results)) for _ in rule_group.atom_rules)
+        else:
+            rule_group, carried_rows = entry
+            rows.extend(carried_rows)
+        excel_list.append(rule_group)
+
+    # 沿用的结果带有 CDSRL 时一并写出，/modify 增量模式下不再重新生成
+    if fused or any(len(row) > 3 and (row[3] or row[4]) for row in rows):
+        headers = HEADERS + ENRICH_HEADERS
+        rows = [row + [''] * (5 - len(row)) for row in rows]
+    else:
+        headers = HEADERS
+        rows = [row[:3] for row in rows]
+    await save_excel(file_name, target_folder, headers, excel_list, rows)
+    return excel_list, rows, changes
+
+
+async def save_excel(file_name: str, target_folder: str, headers: List[str], excel_list: List[RuleObject],
+                     rows: List[List]):
+    """
+    rows 为每个原子条例在 atom_rule_content 之后的各列，顺序与 excel_list 中的原子条例一致
+    """
+    writer = StreamingSheetWriter(headers)
+    results = iter(rows)
 
-    async def add_row(sheet_, row_data):
-        sheet_.append(row_data)
-        await asyncio.sleep(0)  # 让出控制权
+    for rule_group in excel_list:
+        rule_order = rule_group.rule_order
+        rule_content = rule_group.rule_content
+        atom = rule_group.atom
+        atom_rules = rule_group.atom_rules
 
-    async def process_atom_rules(rule_group_):
-        """
-        处理原子条例
-        """
-        rule_order = rule_group_.rule_order
-        rule_content = rule_group_.rule_content
-        atom = rule_group_.atom
-        atom_rules = rule_group_.atom_rules
+        start_row = writer.max_row + 1
+        for index, atom_rule in enumerate(atom_rules):
+            # 多个原子条例时，只在第一行写入条例信息，之后合并单元格
+            prefix = [rule_order, rule_content, atom] if index == 0 else ['', '', '']
+            writer.append(prefix + [atom_rule] + next(results))
 
         if len(atom_rules) > 1:
-            first_atom_rule = atom_rules[0]
-            super_vise_group = await process_rule(first_atom_rule)
-            row_ = [rule_order, rule_content, atom, first_atom_rule, super_vise_group.supervise,
-                    super_vise_group.supervise_category, super_vise_group.supervise_type]
-            await add_row(sheet, row_)
-
-            start_row = sheet.max_row
-
-            for atom_rule in atom_rules[1:]:
-                super_vise_group = await process_rule(atom_rule)
-                row_ = ['', '', '', atom_rule, super_vise_group.supervise,
-                        super_vise_group.supervise_category, super_vise_group.supervise_type]
-                await add_row(sheet, row_)
-
-            end_row = sheet.max_row
-            sheet.merge_cells(start_row=start_row, start_column=1, end_row=end_row, end_column=1)
-            sheet.merge_cells(start_row=start_row, start_column=2, end_row=end_row, end_column=2)
-            sheet.merge_cells(start_row=start_row, start_column=3, end_row=end_row, end_column=3)
-
-            for col in range(1, 4):
-                sheet.cell(row=start_row, column=col).alignment = Alignment(horizontal='center', vertical='center')
+            writer.merge(start_row, writer.max_row, columns=(1, 2, 3))
+
+    # 确保目标文件夹存在
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder)
+
+    # 保存工作簿到指定路径，如果文件存在则覆盖；生成 xlsx 在进程池中执行，不阻塞事件循环
+    with WORKBOOK_DURATION.time(operation="write"):
+        await run_cpu(writer.save, output_path(file_name, target_folder))
+
+
+def output_path(file_name: str, target_folder: str) -> str:
+    # 提取文件名，不包括扩展名，创建新的Excel文件名
+    file_name_without_extension = os.path.splitext(file_name)[0]
+    return os.path.join(target_folder, f"{file_name_without_extension}.xlsx")
+
+
+def upload_phase(fused: bool = False) -> str:
+    # 融合流水线的输出多两列，与普通模式分开记录
+    return f"{UPLOAD_PHASE}+{PostProcessStep.MODIFY.value}" if fused else UPLOAD_PHASE
+
+
+def is_up_to_date(file_path: str, target_folder: str, source_hash: str, skip_up_to_date: bool = False,
+                  fused: bool = False) -> bool:
+    """
+    断点续跑时跳过日志中已完成且内容未变的文件；skip_up_to_date 时还跳过输出比输入新的文件
+    """
+    output = output_path(os.path.basename(file_path), target_folder)
+    journal = current_journal.get()
+    if journal is not None and journal_resume.get() and \
+            journal.is_file_done(upload_phase(fused), file_path, source_hash, output):
+        return True
+    return skip_up_to_date and os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(file_path)
+
+
+async def process_single_file(file_name: str, rule: List, target_folder: str, source_path: Optional[str] = None,
+                              source_hash: Optional[str] = None, fused: bool = False, incremental: bool = False):
+    """
+    返回随结果一起上报的信息：复用的近似重复条例（reused），增量模式下的变更报告（changes）
+    """
+    details = {}
+    journal = current_journal.get()
+    token = None
+    if journal is not None and source_path is not None:
+        token = file_journal.set(journal.for_file(upload_phase(fused), source_path, journal_resume.get()))
+    # 后台任务中已由 JobManager 设置当前文件
+    file_token = current_file.set(source_path or file_name) if current_file.get() is None else None
+    reused = []
+    reuse_token = reuse_report.set(reused)
+    try:
+        start = time.monotonic()
+        previous = find_previous(os.path.abspath(source_path or file_name), file_name) if incremental else None
+        if previous:
+            excel_list, rows, details["changes"] = await run_incremental(file_name, rule, target_folder, previous,
+                                                                         fused)
+        elif fused:
+            excel_list, rows = await run_pipeline(file_name, rule, target_folder)
         else:
-            atom_rule = atom_rules[0]
-            super_vise_group = await process_rule(atom_rule)
-            row_ = [rule_order, rule_content, atom, atom_rule, super_vise_group.supervise,
-                    super_vise_group.supervise_category, super_vise_group.supervise_type]
-            await add_row(sheet, row_)
-
-    async def worker(queue_):
-        while True:
-            rule_group_ = await queue_.get()
-            if rule_group_ is None:
-                break
-            await process_atom_rules(rule_group_)
-            queue_.task_done()
-
-    queue = asyncio.Queue()
-    for rule_group in excel_list:
-        await queue.put(rule_group)
-
-    num_workers = 1  # 保证顺序处理
-    tasks = []
-    for _ in range(num_workers):
-        task = asyncio.create_task(worker(queue))
-        tasks.append(task)
+            excel_list = await get_content(rule)
+            rows = await gen_excel(file_name, excel_list, target_folder)
+        store = get_results_store()
+        if store is not None:
+            store.save_document(os.path.abspath(source_path or file_name), file_name, source_hash,
+                                output_path(file_name, target_folder), excel_list, rows)
+        logger.info("file processed", extra={"fields": {"rules": len(rule),
+                                                        "seconds": round(time.monotonic() - start, 3)}})
+    finally:
+        if token is not None:
+            file_journal.reset(token)
+        if file_token is not None:
+            current_file.reset(file_token)
+        reuse_report.reset(reuse_token)
+    failed = sum(1 for row in rows if row_failed(row, fused))
+    if failed:
+        # 部分条例失败时不记为已完成，断点续跑时只重新请求失败的条例
+        details["failed_rows"] = failed
+    elif journal is not None and source_path is not None:
+        journal.file_done(upload_phase(fused), source_path, source_hash, output_path(file_name, target_folder))
+    if reused:
+        # 复用了近似重复条例已有结果的原子条例
+        details["reused"] = reused
+    return details
+
+
+async def extract_rules(file_path: str, source_hash: str, chunked: bool = False) -> List:
+    """
+    上传文件提取条例列表。chunked 时本地按条文切块并发上传，每块单独重试、单独缓存，
+    部分块失败后重新处理只需请求失败的块；无法解析或只有一块时上传原文件
+    """
+    file_name = os.path.basename(file_path)
+    chunks = []
+    if chunked and file_name.lower().endswith('.docx'):
+        try:
+            chunks = await run_cpu(split_document, file_path, Config.CHUNK_MAX_CHARS)
+        except Exception as e:
+            logger.warning("failed to split document, uploading it whole",
+                           extra={"fields": {"file": file_path, "error": str(e)}})
+    if not chunks:
+        # 直接把打开的文件交给 httpx 流式上传，文件内容不整体读入内存
+        with open(file_path, 'rb') as file:
+            rule_result = await upload_file(UploadFile(filename=file_name, file=file), source_hash)
+        if 'error' in rule_result:
+            raise Exception(f"Upload failed: {rule_result}")
+        return rule_result.get('ruleList', [])
+
+    stem = os.path.splitext(file_name)[0]
+    results = await gather_with_concurrency(
+        Config.CHUNK_CONCURRENCY,
+        (upload_file(UploadFile(filename=f"{stem}.part{index:03d}.docx", file=io.BytesIO(chunk)), digest)
+         for index, (digest, chunk) in enumerate(chunks, 1)),
+        stage="chunk")
+    failed = [index for index, result in enumerate(results, 1) if 'error' in result]
+    if failed:
+        raise Exception(f"Upload failed for chunks {failed} of {len(chunks)}: {results[failed[0] - 1]}")
+    return merge_rule_lists([result.get('ruleList', []) for result in results])
+
+
+async def upload_and_process(file_path: str, target_folder: str, skip_up_to_date: bool = False,
+                             upload_slots: Optional[asyncio.Semaphore] = None, fused: bool = False,
+                             chunked: bool = False, incremental: bool = False):
+    file_name = os.path.basename(file_path)
+    # 按块计算哈希，不阻塞事件循环
+    source_hash = await asyncio.to_thread(file_hash, file_path)
+    if is_up_to_date(file_path, target_folder, source_hash, skip_up_to_date, fused):
+        return {"file": file_path, "status": "Skipped", "reason": "Up to date"}
+    async with upload_slots or nullcontext():
+        rule = await extract_rules(file_path, source_hash, chunked)
+    details = await process_single_file(file_name, rule, target_folder, file_path, source_hash, fused, incremental)
+    return {"file": file_path, "status": "Processed", **details}
+
+
+def list_source_files(origin_folder: str):
+    return sorted(os.path.join(origin_folder, filename) for filename in os.listdir(origin_folder)
+                  if os.path.isfile(os.path.join(origin_folder, filename)))
+
+
+def list_xlsx_files(folder: str):
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(folder)
+                  for file in files if file.lower().endswith('.xlsx'))
+
+
+@app.post('/jobs/upload_file', dependencies=[Depends(scheduling)])
+async def submit_upload_job(origin_folder: str, target_folder: str, cache: CacheMode = CacheMode.USE,
+                            deadline: Optional[float] = None, resume: bool = True, skip_up_to_date: bool = False,
+                            fused: bool = False, chunked: bool = False, incremental: bool = False):
+    """
+    后台处理文件夹，立即返回任务 ID
+    """
+    if not os.path.isdir(origin_folder):
+        raise HTTPException(status_code=400, detail="Invalid folder path")
+    cache_mode.set(cache)
+    set_job_deadline(deadline)
+    use_journal(target_folder, resume)
+    job = job_manager.submit("upload_file", {"origin_folder": origin_folder, "target_folder": target_folder,
+                                             "fused": fused, "chunked": chunked, "incremental": incremental},
+                             list_source_files(origin_folder),
+                             lambda file_path: upload_and_process(file_path, target_folder, skip_up_to_date,
+                                                                  fused=fused, chunked=chunked,
+                                                                  incremental=incremental))
+    return {"job_id": job.id}
+
+
+@app.post('/jobs/modify', dependencies=[Depends(scheduling)])
+async def submit_modify_job(folder: str, cache: CacheMode = CacheMode.USE, deadline: Optional[float] = None,
+                            resume: bool = True, incremental: bool = False):
+    if not os.path.isdir(folder):
+        raise HTTPException(status_code=400, detail="Invalid folder path")
+    cache_mode.set(cache)
+    set_job_deadline(deadline)
+    use_journal(folder, resume)
+    job = job_manager.submit("modify", {"folder": folder, "incremental": incremental}, list_xlsx_files(folder),
+                             lambda file_path: process_file(file_path, incremental))
+    return {"job_id": job.id}
 
-    await queue.join()
 
-    for _ in range(num_workers):
-        await queue.put(None)
+@app.get('/jobs')
+async def list_jobs():
+    return job_manager.snapshots()
 
-    await asyncio.gather(*tasks)
 
-    # 自适应列宽和设置最大宽度
-    for column_cells in sheet.columns:
-        length = max(len(str(cell.value)) for cell in column_cells)
-        adjusted_length = min(length, max_column_width)  # 取最小值，确保不超过最大宽度
-        sheet.column_dimensions[get_column_letter(column_cells[0].column)].width = adjusted_length + 5
+def get_job_or_404(job_id: str):
+    # 多 worker 部署时任务可能由其他 worker 执行，从共享状态读取快照
+    snapshot = job_manager.snapshot(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return snapshot
 
-        # 设置单元格换行和自适应行高，同时设置最大行高
-        for row in sheet.iter_rows():
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True)
-                cell_row = cell.row
-                current_height = sheet.row_dimensions[cell_row].height or 0
-                required_height = 15 * (str(cell.value).count('\n') + 1)
-                sheet.row_dimensions[cell_row].height = max(min(max(current_height, required_height), max_row_height),
-                                                            15)
-        # 确保目标文件夹存在
-        if not os.path.exists(target_folder):
-            os.makedirs(target_folder)
 
-        # 获取上传文件的原始文件名
-        original_filename = file_name
-        # 提取文件名，不包括扩展名
-        file_name_without_extension = os.path.splitext(original_filename)[0]
-        # 创建新的Excel文件名
-        excel_filename = f"{file_name_without_extension}.xlsx"
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str):
+    return get_job_or_404(job_id)
 
-        # 构建完整的文件路径
-        file_path = os.path.join(target_folder, excel_filename)
 
-        # 保存工作簿到指定路径，如果文件存在则覆盖
-        workbook.save(file_path)
+@app.get('/jobs/{job_id}/events')
+async def job_events(job_id: str):
+    get_job_or_404(job_id)
+    job = job_manager.get(job_id)
+    events = job_manager.events(job) if job is not None else job_manager.remote_events(job_id)
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
-async def process_single_file(file_name: str, rule: List, target_folder: str):
-    excel_list = await get_content(rule)
-    await gen_excel(file_name, excel_list, target_folder)
+@app.post('/jobs/{job_id}/cancel')
+async def cancel_job(job_id: str):
+    get_job_or_404(job_id)
+    return job_manager.cancel(job_id)
 
 
 @app.post("/count")
 async def count(target_folder: str):
-    total_count = 0
-    # 遍历文件夹并统计
-    count_file_path = os.path.join(target_folder, 'count.txt')
-    for file_name in os.listdir(target_folder):
-        if file_name.endswith('.xlsx'):
-            file_path = os.path.join(target_folder, file_name)
-            try:
-                df = pd.read_excel(file_path)
-                tmp = df['Automatable_supervision']
-                supervision_count = (tmp == 1).sum()
-                total_count += supervision_count
-                with open(count_file_path, 'a', encoding='utf-8') as count_file:
-                    count_file.write(f"{file_name}: {supervision_count}\n")
-            except Exception as e:
-                return {"message": f"Error processing file {file_name}: {e}"}
-    # 在所有文件处理完毕后，更新 count.txt 文件的总数
-    with open(count_file_path, 'r+', encoding='utf-8') as count_file:
-        content = count_file.read()
-        count_file.seek(0)  # 移动到文件开头
-        count_file.write(f"Total Count: {total_count}\n{content}")
-    return {"message": "Files processed successfully"}
+    file_names = sorted(file_name for file_name in os.listdir(target_folder) if file_name.endswith('.xlsx'))
+    file_paths = [os.path.join(target_folder, file_name) for file_name in file_names]
+
+    # 在共享进程池中并行统计，单个文件出错不影响其他文件
+    async def count_file(file_path: str):
+        with WORKBOOK_DURATION.time(operation="count"):
+            return await run_cpu(count_automatable, file_path)
 
+    results = await asyncio.gather(*(count_file(file_path) for file_path in file_paths), return_exceptions=True)
 
-@app.post('/modify')
-async def modify_xlsx(folder: str):
+    counts = {}
+    errors = {}
+    for file_name, result in zip(file_names, results):
+        if isinstance(result, Exception):
+            errors[file_name] = f"{type(result).__name__}: {result}"
+        else:
+            counts[file_name] = result
+    total_count = sum(counts.values())
+
+    # 先写临时文件再替换，避免中途出错留下不完整的 count.txt
+    count_file_path = os.path.join(target_folder, 'count.txt')
+    lines = [f"Total Count: {total_count}\n"] + [f"{file_name}: {n}\n" for file_name, n in counts.items()]
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=target_folder, suffix='.tmp', delete=False) as tmp:
+        tmp.writelines(lines)
+    os.replace(tmp.name, count_file_path)
+
+    message = "Files processed successfully" if not errors else f"Processed with {len(errors)} errors"
+    return {"message": message, "total_count": total_count, "counts": counts, "errors": errors}
+
+
+@app.post('/modify', dependencies=[Depends(scheduling)])
+async def modify_xlsx(folder: str, cache: CacheMode = CacheMode.USE, deadline: Optional[float] = None,
+                      resume: bool = True, incremental: bool = False):
+    """
+    incremental 为 True 时跳过已有 CDSRL 结果的行，只为新增、修改的原子条例生成
+    """
+    cache_mode.set(cache)
+    set_job_deadline(deadline)
+    use_journal(folder, resume)
     tasks = []
     for root, _, files in os.walk(folder):
         for file in files:
             if file.lower().endswith('.xlsx'):
                 file_path = os.path.join(root, file)
-                tasks.append(process_file(file_path))
+                tasks.append(process_file(file_path, incremental))
 
     results = await asyncio.gather(*tasks)
     return {"message": "Processing complete", "results": results}
 
 
-def flatten_dict(d, parent_key='', sep='_'):
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
-        elif isinstance(v, list):
-            items.append((new_key, json.dumps(v, ensure_ascii=False)))
-        else:
-            items.append((new_key, str(v)))
-    return dict(items)
-
-
-async def process_file(file_path: str):
-    try:
-        if not os.path.exists(file_path):
-            return {"file": file_path, "status": "Failed", "error": "File does not exist"}
-        os.chmod(file_path, 0o666)
-        print("File permissions modified successfully!")
-        # 读取Excel文件，保留原有格式
-        workbook = load_workbook(file_path)
-        sheet = workbook.active
-
-        # 读取数据到DataFrame
-        df = pd.DataFrame(sheet.values)
-        df.columns = df.iloc[0]  # 使用第一行作为列名
-        df = df.drop(df.index[0])  # 删除重复的列名行
-    except PermissionError:
-        return {"file": file_path, "status": "Failed to read",
-                "error": "Permission denied. The file might be open in another program."}
-    except Exception as e:
-        return {"file": file_path, "status": "Failed to read", "error": str(e)}
-
-    # 创建新的DataFrame列
-    if 'common_element' not in df.columns:
-        df['common_element'] = None
-    if 'CDSRL_result' not in df.columns:
-        df['CDSRL_result'] = None
-
-    # 创建任务列表以并发执行
-    process_tasks = []
-    for row_index in range(len(df)):
-        if df.iloc[row_index]['Automatable_supervision'] == 1:
-            process_tasks.append(process_row(df, row_index, df.iloc[row_index]))
-
-    # 并发执行任务
-    await asyncio.gather(*process_tasks)
-
-    # 将修改后的数据写回到工作表
-    for r_idx, row in enumerate(df.values, start=2):  # 从第2行开始，因为第1行是列名
-        for c_idx, value in enumerate(row, start=1):
-            if isinstance(value, dict):
-                # 如果值是字典，将其扁平化并转换为JSON字符串
-                flattened_value = flatten_dict(value)
-                cell_value = json.dumps(flattened_value, ensure_ascii=False)
-            elif isinstance(value, list):
-                # 如果值是列表，直接转换为JSON字符串
-                cell_value = json.dumps(value, ensure_ascii=False)
-            else:
-                cell_value = value
-            sheet.cell(row=r_idx, column=c_idx, value=cell_value)
-    try:
-        workbook.save(file_path)
-        return {"file": file_path, "status": "Modified"}
-    except Exception as e:
-        return {"file": file_path, "status": "Failed to save", "error": str(e)}
+async def process_file(file_path: str, incremental: bool = False):
+    return await apply_transforms(file_path, [EnrichTransform(skip_enriched=incremental)])
 
 
-async def process_row(df: pd.DataFrame, row_index: int, row: pd.Series):
-    try:
-        entity_info = await extract_common_element(row['atom_rule_content'], row['category'])
-        print(f"Row {row_index}: entity_info", entity_info)
-
-        # 使用 iloc 按位置访问行
-        df.iloc[row_index, df.columns.get_loc('common_element')] = json.dumps(entity_info, ensure_ascii=False)
-
-        cdsrl_result = await generate_cdsrl(row['atom_rule_content'], row['category'], entity_info)
-        print(f"Row {row_index}: cdsrl_result", cdsrl_result)
-        print("========================")
-
-        # 使用 iloc 按位置访问行
-        df.iloc[row_index, df.columns.get_loc('CDSRL_result')] = json.dumps(cdsrl_result, ensure_ascii=False)
-    except Exception as e:
-        print(f"Error processing row {row_index}: {str(e)}")
-        # 可以选择在这里设置一个错误值
-        df.iloc[row_index, df.columns.get_loc('common_element')] = json.dumps({"error": str(e)}, ensure_ascii=False)
-        df.iloc[row_index, df.columns.get_loc('CDSRL_result')] = json.dumps({"error": str(e)}, ensure_ascii=False)
-
-
-def process_excel(file_path):
-    workbook = load_workbook(file_path)
-    sheet = workbook.active
-
-    # 检查是否已存在这两列，如果不存在则添加
-    if 'common_element' not in sheet[1]:
-        sheet.cell(row=1, column=sheet.max_column - 1, value='common_element')
-    if 'CDSRL_result' not in sheet[1]:
-        sheet.cell(row=1, column=sheet.max_column, value='CDSRL_result')
-
-    # 获取这两列的列号
-    common_element_col = None
-    cdsrl_result_col = None
-    for cell in sheet[1]:
-        if cell.value == 'common_element':
-            common_element_col = cell.column
-        elif cell.value == 'CDSRL_result':
-            cdsrl_result_col = cell.column
-
-    if common_element_col and cdsrl_result_col:
-        for col in [common_element_col, cdsrl_result_col]:
-            letter = get_column_letter(col)
-            max_length = 0
-            for cell in sheet[letter]:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            adjusted_width = (max_length + 2) * 1.2
-            sheet.column_dimensions[letter].width = adjusted_width
-
-            for cell in sheet[letter]:
-                cell.alignment = Alignment(vertical='bottom', wrap_text=True)
-
-    workbook.save(file_path)
+async def process_excel(file_path):
+    result = await apply_transforms(file_path, [BeautifyTransform()])
+    if result["status"] != "Modified":
+        raise Exception(result["error"])
 
 
 @app.post("/beautify")
 async def beautify_excel_files(folder_path: str):
     if not os.path.isdir(folder_path):
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail="Invalid folder path")
 
     processed_files = []
@@ -364,37 +589,23 @@ async def beautify_excel_files(folder_path: str):
         if filename.endswith('.xlsx'):
             file_path = os.path.join(folder_path, filename)
             try:
-                process_excel(file_path)
+                await process_excel(file_path)
                 processed_files.append(filename)
             except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
+                logger.error("failed to process workbook", extra={"fields": {"file": filename, "error": str(e)}})
 
     return {"message": f"Processed {len(processed_files)} files", "processed_files": processed_files}
 
 
-def set_column_width(file_path: str, width: float = 15):
-    workbook = load_workbook(file_path)
-    sheet = workbook.active
-
-    # 获取最后两列的列号
-    last_column = sheet.max_column
-    second_last_column = last_column - 1
-
-    # 将厘米转换为Excel单位（约4.7个字符宽度等于1厘米）
-    width_excel_units = width
-
-    # 设置最后两列的宽度
-    for col in [second_last_column, last_column]:
-        column_letter = get_column_letter(col)
-        sheet.column_dimensions[column_letter].width = width_excel_units
-
-    workbook.save(file_path)
+async def set_column_width(file_path: str, width: float = 15):
+    result = await apply_transforms(file_path, [ColumnWidthTransform(width)])
+    if result["status"] != "Modified":
+        raise Exception(result["error"])
 
 
 @app.post("/set_column_width")
 async def set_excel_column_width(folder_path: str, width: float = 30):
     if not os.path.isdir(folder_path):
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail="Invalid folder path")
 
     processed_files = []
@@ -402,13 +613,141 @@ async def set_excel_column_width(folder_path: str, width: float = 30):
         if filename.endswith(('.xlsx', '.xls')):
             file_path = os.path.join(folder_path, filename)
             try:
-                set_column_width(file_path, width)
+                await set_column_width(file_path, width)
                 processed_files.append(filename)
             except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
+                logger.error("failed to process workbook", extra={"fields": {"file": filename, "error": str(e)}})
 
     return {"message": f"Processed {len(processed_files)} files", "processed_files": processed_files}
 
 
+@app.post("/post_process", dependencies=[Depends(scheduling)])
+async def post_process(folder: str, steps: List[PostProcessStep] = Query(list(PostProcessStep)), width: float = 30,
+                       cache: CacheMode = CacheMode.USE, deadline: Optional[float] = None, resume: bool = True):
+    """
+    每个文件只加载、保存一次，依次执行所选的补充 CDSRL、美化、设置列宽步骤
+    """
+    if not os.path.isdir(folder):
+        raise HTTPException(status_code=400, detail="Invalid folder path")
+    cache_mode.set(cache)
+    set_job_deadline(deadline)
+    use_journal(folder, resume)
+
+    tasks = []
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if file.lower().endswith('.xlsx'):
+                tasks.append(apply_transforms(os.path.join(root, file), build_transforms(steps, width)))
+
+    results = await asyncio.gather(*tasks)
+    return {"message": "Processing complete", "results": results}
+
+
+def get_results_store_or_400():
+    store = get_results_store()
+    if store is None:
+        raise HTTPException(status_code=400, detail="Results store is disabled")
+    return store
+
+
+def get_document_or_404(store, document: str):
+    found = store.find_document(document)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return found
+
+
+@app.get("/results/documents")
+async def list_documents():
+    return get_results_store_or_400().documents()
+
+
+@app.get("/results/counts")
+async def result_counts(group_by: ResultGroupBy = ResultGroupBy.CATEGORY, document: Optional[str] = None,
+                        automatable_only: bool = False):
+    """
+    直接从结果库统计原子条例数，不需要解析 xlsx；document 可以是源文件路径或文件名
+    """
+    store = get_results_store_or_400()
+    document_id = get_document_or_404(store, document)["id"] if document else None
+    counts = store.counts(group_by, document_id, automatable_only)
+    return {"group_by": group_by.value, "total_count": sum(counts.values()), "counts": counts}
+
+
+@app.post("/results/export")
+async def export_results(document: str, target_folder: str):
+    """
+    按 gen_excel 的格式从结果库导出 xlsx，已补充 CDSRL 的文档额外导出 common_element、CDSRL_result 两列
+    """
+    store = get_results_store_or_400()
+    found = get_document_or_404(store, document)
+    excel_list, rows = store.load_document(found["id"])
+    headers = HEADERS
+    if any(row[3] or row[4] for row in rows):
+        headers = HEADERS + ENRICH_HEADERS
+    else:
+        rows = [row[:3] for row in rows]
+    await save_excel(found["name"], target_folder, headers, excel_list, rows)
+    return {"message": "Exported", "file": output_path(found["name"], target_folder)}
+
+
+@app.get("/pool_stats")
+async def pool_stats():
+    return APIRequest.pool_stats()
+
+
+@app.get("/rate_limits")
+async def rate_limits():
+    return limiter_stats()
+
+
+@app.get("/retry_stats")
+async def retry_stats():
+    return retry_policy.stats()
+
+
+@app.get("/singleflight_stats")
+async def singleflight_stats():
+    return single_flight.stats()
+
+
+@app.get("/scheduler_stats")
+async def get_scheduler_stats():
+    return scheduler_stats()
+
+
+@app.get("/speculation_stats")
+async def get_speculation_stats():
+    return speculation_stats()
+
+
+@app.get("/similarity_stats")
+async def similarity_stats():
+    index = get_similarity_index()
+    if index is None:
+        return {"message": "Similarity reuse is disabled"}
+    return index.stats()
+
+
+@app.get("/cache_stats")
+async def cache_stats():
+    cache = get_cache()
+    if cache is None:
+        return {"message": "Cache is disabled"}
+    return cache.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus 文本格式的指标
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=8000)
+    if Config.WORKERS > 1:
+        # 多 worker 时 uvicorn 需要以导入路径启动应用，每个 worker 各自导入
+        uvicorn.run('main:app', host='0.0.0.0', port=8000, workers=Config.WORKERS)
+    else:
+        uvicorn.run(app, host='0.0.0.0', port=8000)
@@ -0,0 +1,239 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from config import Config
+from logger import get_logger
+from metrics import CallbackCounter, Gauge, RATE_LIMITER_WAIT, registry
+from shared_state import SharedState, get_shared_state
+
+logger = get_logger(__name__)
+
+# 视为上游过载的状态码，自适应模式下收到后降低速率
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+# 归还共享并发名额时遇到写锁繁忙的最多尝试次数
+RELEASE_ATTEMPTS = 5
+
+
+class AdaptiveRateLimiter:
+    """
+    异步令牌桶限流器，同时限制并发数。
+    自适应模式按 AIMD 调整速率：上游过载时乘性降低，响应延迟正常时加性提升
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int, adaptive: bool = False,
+                 min_rate: float = 0.1, max_rate: float = 100.0, increase: float = 1.0, decrease: float = 0.5,
+                 target_latency: float = 10.0, cooldown: float = 5.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.last_decrease_at = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        # 持有锁期间等待令牌，等待者按先来后到依次放行，不会同时读取到同一状态
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        start = time.monotonic()
+        async with self._semaphore:
+            await self.acquire()
+            waited = time.monotonic() - start
+            self.wait_seconds += waited
+            RATE_LIMITER_WAIT.observe(waited, endpoint=self.name)
+            self.calls += 1
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+
+    def record(self, status_code: Optional[int], latency: float):
+        """
+        记录一次请求结果，status_code 为 None 表示请求异常（超时、连接失败等）
+        """
+        if not self.adaptive:
+            return
+        if status_code is None or status_code in OVERLOAD_STATUS_CODES:
+            self.throttled += 1
+            now = time.monotonic()
+            # 冷却期内只降低一次，避免同一批失败请求把速率压到最低
+            if now - self.last_decrease_at >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease_at = now
+        elif latency <= self.target_latency:
+            # 每秒约提升 increase
+            self.rate = min(self.max_rate, self.rate + self.increase / max(self.rate, 1.0))
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 3),
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+class SharedRateLimiter(AdaptiveRateLimiter):
+    """
+    多 worker 部署时使用：令牌桶、并发名额和自适应速率保存在共享状态中，
+    所有 worker 合计遵守同一份上游预算；进程内的信号量和锁只用于减少对共享状态的争用。
+    共享状态的读写在线程中执行，不阻塞事件循环；每次调用只有取得名额、归还名额两个事务，
+    调用结果在归还名额时一起计入自适应速率
+    """
+
+    def __init__(self, name: str, shared: SharedState, **settings):
+        super().__init__(name, **settings)
+        self.shared = shared
+        self.configured_rate = self.rate
+        # 尚未写入共享状态的调用结果（是否过载）
+        self._outcomes: List[bool] = []
+        # 本进程归还名额时唤醒等待者，不必等到下一次轮询
+        self._released = asyncio.Event()
+
+    async def acquire(self) -> int:
+        # 持有进程内的锁轮询，本进程的等待者依次放行
+        async with self._lock:
+            interval = Config.SHARED_POLL_INTERVAL
+            while True:
+                self._released.clear()
+                try:
+                    lease_id, wait = await asyncio.to_thread(self.shared.try_acquire, self.name,
+                                                             self.configured_rate, self.burst, self.concurrency)
+                except sqlite3.OperationalError:
+                    # 其他 worker 持有写锁，稍后重试
+                    lease_id, wait = None, interval
+                if lease_id is not None:
+                    return lease_id
+                if wait <= Config.SHARED_POLL_INTERVAL:
+                    # 并发名额已满时逐步拉长轮询间隔
+                    wait = interval
+                    interval = min(interval * 2, Config.SHARED_POLL_MAX_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._released.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _release(self, lease_id: int, outcomes: List[bool]) -> Optional[float]:
+        # 在线程中执行；写锁繁忙时重试，名额不归还会一直占用到租约过期
+        for attempt in range(RELEASE_ATTEMPTS):
+            try:
+                return self.shared.release(lease_id, self.name, outcomes, self.min_rate, self.max_rate,
+                                           self.increase, self.decrease, self.cooldown)
+            except sqlite3.OperationalError:
+                if attempt == RELEASE_ATTEMPTS - 1:
+                    raise
+                time.sleep(Config.SHARED_POLL_INTERVAL)
+        return None
+
+    @asynccontextmanager
+    async def slot(self):
+        start = time.monotonic()
+        async with self._semaphore:
+            lease_id = await self.acquire()
+            try:
+                waited = time.monotonic() - start
+                self.wait_seconds += waited
+                RATE_LIMITER_WAIT.observe(waited, endpoint=self.name)
+                self.calls += 1
+                self.in_flight += 1
+                try:
+                    yield
+                finally:
+                    self.in_flight -= 1
+            finally:
+                outcomes, self._outcomes = self._outcomes, []
+                try:
+                    rate = await asyncio.to_thread(self._release, lease_id, outcomes)
+                except sqlite3.OperationalError as e:
+                    logger.warning("failed to release shared slot", extra={"fields": {
+                        "endpoint": self.name, "lease_id": lease_id, "error": str(e)}})
+                else:
+                    if rate is not None:
+                        self.rate = rate
+                self._released.set()
+
+    def record(self, status_code: Optional[int], latency: float):
+        if not self.adaptive:
+            return
+        overloaded = status_code is None or status_code in OVERLOAD_STATUS_CODES
+        if overloaded:
+            self.throttled += 1
+        elif latency > self.target_latency:
+            return
+        self._outcomes.append(overloaded)
+
+    def stats(self):
+        stats = super().stats()
+        # 所有 worker 合计持有的并发名额
+        stats["shared_in_flight"] = self.shared.in_flight().get(self.name, 0)
+        return stats
+
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+
+
+def endpoint_name(url: str) -> str:
+    return urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def get_limiter(url: str) -> AdaptiveRateLimiter:
+    name = endpoint_name(url)
+    limiter = _limiters.get(name)
+    if limiter is None:
+        settings = dict(Config.RATE_LIMITS.get("default", {}))
+        settings.update(Config.RATE_LIMITS.get(name, {}))
+        shared = get_shared_state()
+        if shared is not None:
+            limiter = _limiters[name] = SharedRateLimiter(name, shared, **settings)
+        else:
+            limiter = _limiters[name] = AdaptiveRateLimiter(name, **settings)
+    return limiter
+
+
+def limiter_stats():
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+def _limiter_values(field: str):
+    return lambda: {(name,): getattr(limiter, field) for name, limiter in _limiters.items()}
+
+
+registry.register(Gauge('rate_limiter_rate', 'Current token bucket rate per endpoint', ('endpoint',),
+                        _limiter_values('rate')))
+registry.register(Gauge('rate_limiter_in_flight', 'Requests holding a limiter slot', ('endpoint',),
+                        _limiter_values('in_flight')))
+registry.register(CallbackCounter('rate_limiter_throttled_total', 'Overload responses seen by the limiter',
+                                  ('endpoint',), _limiter_values('throttled')))
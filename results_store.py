@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import Config
+from constant import AutoSupervision, ResultGroupBy
+from model import RuleObject
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    source_hash TEXT,
+    output TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_documents_name ON documents (name);
+CREATE INDEX IF NOT EXISTS idx_documents_output ON documents (output);
+CREATE TABLE IF NOT EXISTS rules (
+    document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    rule_index INTEGER NOT NULL,
+    rule_order TEXT NOT NULL,
+    rule_content TEXT NOT NULL,
+    atom TEXT NOT NULL,
+    PRIMARY KEY (document_id, rule_index)
+);
+CREATE INDEX IF NOT EXISTS idx_rules_rule_order ON rules (document_id, rule_order);
+CREATE TABLE IF NOT EXISTS atom_rules (
+    document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    rule_index INTEGER NOT NULL,
+    atom_index INTEGER NOT NULL,
+    atom_rule_content TEXT NOT NULL,
+    supervise TEXT,
+    category TEXT,
+    type TEXT,
+    common_element TEXT,
+    cdsrl_result TEXT,
+    PRIMARY KEY (document_id, rule_index, atom_index)
+);
+CREATE INDEX IF NOT EXISTS idx_atom_rules_category ON atom_rules (category, type);
+CREATE INDEX IF NOT EXISTS idx_atom_rules_supervise ON atom_rules (supervise);
+"""
+
+
+def _nullable(value: Any) -> Optional[str]:
+    return None if value is None or value == '' else str(value)
+
+
+class ResultsStore:
+    """
+    基于 SQLite 的处理结果库：documents、rules、atom_rules 三张表，
+    按文档、条例位置（rule_order 所在序号）和原子条例序号寻址，xlsx 只是导出格式
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def save_document(self, path: str, name: str, source_hash: Optional[str], output: Optional[str],
+                      excel_list: List[RuleObject], rows: Sequence[Sequence[Any]]):
+        """
+        整体替换一个文档的结果。rows 与 gen_excel 相同：每个原子条例一行，
+        依次为 supervise、category、type，融合流水线另有 common_element、CDSRL_result
+        """
+        output = os.path.abspath(output) if output else None
+        results = iter(rows)
+        rule_records = []
+        atom_records = []
+        for rule_index, rule_group in enumerate(excel_list):
+            rule_records.append((rule_index, rule_group.rule_order, rule_group.rule_content, rule_group.atom))
+            for atom_index, atom_rule in enumerate(rule_group.atom_rules):
+                row = list(next(results)) + [None, None]
+                atom_records.append((rule_index, atom_index, atom_rule, *(_nullable(value) for value in row[:5])))
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO documents (path, name, source_hash, output, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET name = excluded.name, source_hash = excluded.source_hash, "
+                "output = excluded.output, updated_at = excluded.updated_at",
+                (path, name, source_hash, output, time.time()))
+            document_id = self._conn.execute("SELECT id FROM documents WHERE path = ?", (path,)).fetchone()[0]
+            self._conn.execute("DELETE FROM atom_rules WHERE document_id = ?", (document_id,))
+            self._conn.execute("DELETE FROM rules WHERE document_id = ?", (document_id,))
+            self._conn.executemany(
+                "INSERT INTO rules (document_id, rule_index, rule_order, rule_content, atom) VALUES (?, ?, ?, ?, ?)",
+                [(document_id, *record) for record in rule_records])
+            self._conn.executemany(
+                "INSERT INTO atom_rules (document_id, rule_index, atom_index, atom_rule_content, supervise, category, "
+                "type, common_element, cdsrl_result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(document_id, *record) for record in atom_records])
+
+    def update_enrichment(self, output: str, updates: Dict[int, Tuple[str, str]]) -> int:
+        """
+        按导出的 xlsx 写回 /modify 的结果，updates 的键为数据行号（从 0 开始），
+        与文档中原子条例的先后顺序一一对应；不是由本服务生成的工作簿直接忽略
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM documents WHERE output = ? ORDER BY updated_at DESC LIMIT 1",
+                                     (os.path.abspath(output),)).fetchone()
+            if row is None or not updates:
+                return 0
+            keys = self._conn.execute(
+                "SELECT rule_index, atom_index FROM atom_rules WHERE document_id = ? ORDER BY rule_index, atom_index",
+                (row[0],)).fetchall()
+            records = [(common_element, cdsrl, row[0], *keys[row_index])
+                       for row_index, (common_element, cdsrl) in updates.items() if row_index < len(keys)]
+            self._conn.executemany(
+                "UPDATE atom_rules SET common_element = ?, cdsrl_result = ? "
+                "WHERE document_id = ? AND rule_index = ? AND atom_index = ?", records)
+            return len(records)
+
+    def find_document(self, document: str) -> Optional[Dict[str, Any]]:
+        # 可以传源文件路径，也可以只传文件名（重名时取最近处理的）
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, path, name, source_hash, output, updated_at FROM documents WHERE path = ? OR name = ? "
+                "ORDER BY path = ? DESC, updated_at DESC LIMIT 1", (document, document, document)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("id", "path", "name", "source_hash", "output", "updated_at"), row))
+
+    def documents(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT d.id, d.path, d.name, d.output, d.updated_at, "
+                "(SELECT COUNT(*) FROM rules r WHERE r.document_id = d.id), "
+                "(SELECT COUNT(*) FROM atom_rules a WHERE a.document_id = d.id) "
+                "FROM documents d ORDER BY d.name").fetchall()
+        return [dict(zip(("id", "path", "name", "output", "updated_at", "rules", "atom_rules"), row)) for row in rows]
+
+    def counts(self, group_by: ResultGroupBy, document_id: Optional[int] = None,
+               automatable_only: bool = False) -> Dict[str, int]:
+        # 列名来自枚举，可以直接拼入 SQL
+        column = ResultGroupBy(group_by).value
+        conditions = []
+        params: List[Any] = []
+        if document_id is not None:
+            conditions.append("document_id = ?")
+            params.append(document_id)
+        if automatable_only:
+            conditions.append("supervise = ?")
+            params.append(str(AutoSupervision.AUTO_SUPERVISED.value))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT COALESCE({column}, ''), COUNT(*) FROM atom_rules {where} "
+                f"GROUP BY {column} ORDER BY COUNT(*) DESC", params).fetchall()
+        return dict(rows)
+
+    def load_document(self, document_id: int) -> Tuple[List[RuleObject], List[List[Any]]]:
+        """
+        读出与 save_document 相同结构的数据，导出 xlsx 时复用 save_excel
+        """
+        with self._lock:
+            rules = self._conn.execute(
+                "SELECT rule_index, rule_order, rule_content, atom FROM rules WHERE document_id = ? "
+                "ORDER BY rule_index", (document_id,)).fetchall()
+            atoms = self._conn.execute(
+                "SELECT rule_index, atom_rule_content, supervise, category, type, common_element, cdsrl_result "
+                "FROM atom_rules WHERE document_id = ? ORDER BY rule_index, atom_index", (document_id,)).fetchall()
+        atom_rules: Dict[int, List[str]] = {}
+        rows = []
+        for rule_index, atom_rule, *values in atoms:
+            atom_rules.setdefault(rule_index, []).append(atom_rule)
+            rows.append(['' if value is None else value for value in values])
+        excel_list = [RuleObject(rule_order=rule_order, rule_content=rule_content, atom=atom,
+                                 atom_rules=atom_rules.get(rule_index, []))
+                      for rule_index, rule_order, rule_content, atom in rules]
+        return excel_list, rows
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_results_store: Optional[ResultsStore] = None
+
+
+def get_results_store() -> Optional[ResultsStore]:
+    global _results_store
+    if not Config.RESULTS_STORE_ENABLED:
+        return None
+    if _results_store is None:
+        _results_store = ResultsStore(Config.RESULTS_STORE_PATH)
+    return _results_store
+
+
+def close_results_store():
+    global _results_store
+    if _results_store is not None:
+        _results_store.close()
+        _results_store = None
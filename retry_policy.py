@@ -0,0 +1,215 @@
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from config import Config
+from logger import get_logger
+from metrics import CallbackCounter, Gauge, registry
+from rate_limiter import endpoint_name
+
+logger = get_logger(__name__)
+
+# 当前任务的截止时间（time.monotonic），由接口设置，随任务上下文传递到所有上游调用
+job_deadline: ContextVar[Optional[float]] = ContextVar("job_deadline", default=None)
+
+
+class UpstreamError(Exception):
+    def __init__(self, url: str, status_code: int):
+        super().__init__(f"Upstream error {status_code} for URL: {url}")
+        self.status_code = status_code
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, UpstreamError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def set_job_deadline(seconds: Optional[float]):
+    seconds = seconds if seconds is not None else Config.JOB_DEADLINE
+    job_deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后断开，reset_timeout 秒内直接失败；
+    之后进入半开状态，只放行一个探测请求，成功则恢复
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self):
+        self._probing = False
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryBudget:
+    """
+    全局重试预算：每次首次请求存入 ratio 个令牌，每次重试消耗 1 个，
+    上游整体故障时重试总量不超过请求量的 ratio 倍
+    """
+
+    def __init__(self, ratio: float, min_tokens: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    def __init__(self):
+        self.budget = RetryBudget(Config.RETRY_BUDGET_RATIO, Config.RETRY_BUDGET_MIN, Config.RETRY_BUDGET_MAX)
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def _breaker(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(Config.CIRCUIT_FAILURE_THRESHOLD,
+                                                           Config.CIRCUIT_RESET_TIMEOUT)
+        return breaker
+
+    def _count(self, name: str, key: str):
+        counters = self.counters.setdefault(name, {"calls": 0, "attempts": 0, "retries": 0, "failures": 0,
+                                                   "rejected": 0, "budget_exhausted": 0, "deadline_exceeded": 0})
+        counters[key] += 1
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        # 指数退避加全抖动
+        return random.uniform(0, min(Config.RETRY_MAX_DELAY, Config.RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def call(self, url: str, attempt_fn: Callable[[], Awaitable[Any]]):
+        name = endpoint_name(url)
+        breaker = self._breaker(name)
+        deadline = time.monotonic() + Config.CALL_DEADLINE
+        if job_deadline.get() is not None:
+            deadline = min(deadline, job_deadline.get())
+
+        self._count(name, "calls")
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count(name, "rejected")
+                raise CircuitOpenError(f"Circuit open for {name}")
+            # 半开状态下放行的请求就是唯一的探测请求，只有它可以归还探测名额
+            probe = breaker.state == CircuitBreaker.HALF_OPEN
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count(name, "deadline_exceeded")
+                raise DeadlineExceeded(f"Deadline exceeded for {name}")
+
+            self._count(name, "attempts")
+            try:
+                result = await asyncio.wait_for(attempt_fn(), remaining)
+            except asyncio.CancelledError:
+                if probe:
+                    breaker.release()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # 非上游故障（如参数错误），释放半开探测但不计入熔断
+                    if probe:
+                        breaker.success()
+                    raise
+                breaker.failure()
+                self._count(name, "failures")
+                delay = self.backoff(attempt)
+                attempt += 1
+                if attempt >= Config.RETRY_MAX_ATTEMPTS or breaker.state == CircuitBreaker.OPEN:
+                    raise
+                if time.monotonic() + delay >= deadline:
+                    self._count(name, "deadline_exceeded")
+                    raise
+                if not self.budget.withdraw():
+                    self._count(name, "budget_exhausted")
+                    raise
+                self._count(name, "retries")
+                logger.warning("retrying upstream call", extra={"fields": {
+                    "endpoint": name, "attempt": attempt, "delay": round(delay, 3), "error": str(e)}})
+                await asyncio.sleep(delay)
+                continue
+            breaker.success()
+            return result
+
+    def stats(self):
+        return {
+            "budget_tokens": round(self.budget.tokens, 2),
+            "endpoints": {
+                name: dict(counters, circuit=self._breaker(name).state, trips=self._breaker(name).trips)
+                for name, counters in self.counters.items()
+            },
+        }
+
+
+retry_policy = RetryPolicy()
+
+
+registry.register(CallbackCounter(
+    'retry_policy_events_total', 'Retry policy events (calls, attempts, retries, failures, rejections...)',
+    ('endpoint', 'event'),
+    lambda: {(name, event): value for name, counters in retry_policy.counters.items()
+             for event, value in counters.items()}))
+registry.register(CallbackCounter(
+    'circuit_breaker_trips_total', 'Times the circuit breaker opened', ('endpoint',),
+    lambda: {(name,): breaker.trips for name, breaker in retry_policy.breakers.items()}))
+registry.register(Gauge(
+    'circuit_breaker_open', '1 when the circuit breaker is not closed', ('endpoint',),
+    lambda: {(name,): int(breaker.state != CircuitBreaker.CLOSED) for name, breaker in retry_policy.breakers.items()}))
+registry.register(Gauge('retry_budget_tokens', 'Tokens left in the global retry budget', (),
+                        lambda: {(): retry_policy.budget.tokens}))
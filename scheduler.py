@@ -0,0 +1,180 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+
+from config import Config
+from constant import Priority
+from jobs import current_job
+from metrics import CallbackCounter, Gauge, Histogram, registry
+from rate_limiter import endpoint_name
+from retry_policy import DeadlineExceeded, job_deadline
+
+PRIORITY_RANK = {Priority.HIGH: 0, Priority.NORMAL: 1, Priority.LOW: 2}
+
+# 同步接口按调用方排队，由接口依赖设置；后台任务按任务 ID 排队
+current_flow: ContextVar[Optional[str]] = ContextVar("current_flow", default=None)
+current_priority: ContextVar[Priority] = ContextVar("current_priority", default=Priority.NORMAL)
+
+SCHEDULER_WAIT = registry.register(Histogram(
+    'scheduler_wait_seconds', 'Time upstream calls spend queued in the scheduler', ('endpoint', 'priority')))
+
+
+def set_flow(flow: Optional[str], priority: Priority = Priority.NORMAL):
+    current_flow.set(flow)
+    current_priority.set(priority)
+
+
+def flow_name() -> str:
+    job = current_job.get()
+    if job is not None:
+        return f"job:{job.id}"
+    flow = current_flow.get()
+    return f"client:{flow}" if flow else "default"
+
+
+class Ticket:
+    def __init__(self, priority: Priority, deadline: Optional[float]):
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def rank(self, now: float) -> int:
+        # 等待超过 SCHEDULER_AGING 秒的请求每次提升一级，低优先级不会一直饿死
+        return PRIORITY_RANK[self.priority] - int((now - self.enqueued_at) / Config.SCHEDULER_AGING)
+
+
+class Flow:
+    def __init__(self, name: str):
+        self.name = name
+        self.queue: Deque[Ticket] = deque()
+        # 每个调用方排队的请求数有上限，队列满时提交方等待，形成反压
+        self.space = asyncio.Semaphore(Config.SCHEDULER_QUEUE_SIZE)
+        self.pending = 0
+
+
+class FairScheduler:
+    """
+    单个上游接口的调度器：按调用方（后台任务或客户端）分队列，
+    优先级高的先执行，同一优先级的调用方轮流执行，截止时间临近的请求优先，已过截止时间的请求不再发出
+    """
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.running = 0
+        self.flows: "OrderedDict[str, Flow]" = OrderedDict()
+        self.dispatched = 0
+        self.expired = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(flow.queue) for flow in self.flows.values())
+
+    @asynccontextmanager
+    async def slot(self):
+        name = flow_name()
+        flow = self.flows.get(name)
+        if flow is None:
+            flow = self.flows[name] = Flow(name)
+        flow.pending += 1
+        try:
+            async with flow.space:
+                ticket = Ticket(current_priority.get(), job_deadline.get())
+                flow.queue.append(ticket)
+                self._dispatch()
+                try:
+                    await ticket.future
+                except asyncio.CancelledError:
+                    if ticket in flow.queue:
+                        flow.queue.remove(ticket)
+                    elif ticket.future.done() and not ticket.future.cancelled() \
+                            and ticket.future.exception() is None:
+                        # 已分配到名额后被取消，归还名额
+                        self._release()
+                    raise
+        finally:
+            flow.pending -= 1
+            if flow.pending == 0 and self.flows.get(name) is flow:
+                del self.flows[name]
+        waited = time.monotonic() - ticket.enqueued_at
+        SCHEDULER_WAIT.observe(waited, endpoint=self.name, priority=ticket.priority.value)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.concurrency:
+            flow = self._next_flow()
+            if flow is None:
+                return
+            ticket = flow.queue.popleft()
+            # 被服务的调用方移到队尾，同一优先级的调用方轮流执行
+            self.flows.move_to_end(flow.name)
+            if ticket.deadline is not None and ticket.deadline <= time.monotonic():
+                self.expired += 1
+                ticket.future.set_exception(DeadlineExceeded(f"Deadline exceeded while queued for {self.name}"))
+                continue
+            self.running += 1
+            self.dispatched += 1
+            ticket.future.set_result(None)
+
+    def _next_flow(self) -> Optional[Flow]:
+        now = time.monotonic()
+        best = None
+        best_key = None
+        for flow in self.flows.values():
+            if not flow.queue:
+                continue
+            head = flow.queue[0]
+            # 截止时间在 SCHEDULER_DEADLINE_SLACK 秒内的请求在同一优先级内先执行，其余按轮转顺序
+            urgent = head.deadline is not None and head.deadline - now <= Config.SCHEDULER_DEADLINE_SLACK
+            key = (head.rank(now), 0 if urgent else 1, head.deadline if urgent else 0.0)
+            if best_key is None or key < best_key:
+                best, best_key = flow, key
+        return best
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "dispatched": self.dispatched,
+            "expired": self.expired,
+            "flows": {name: len(flow.queue) for name, flow in self.flows.items() if flow.queue},
+        }
+
+
+_schedulers: Dict[str, FairScheduler] = {}
+
+
+def get_scheduler(url: str) -> FairScheduler:
+    # 并发数与该接口的限流配置一致，排队发生在调度器中而不是限流器中
+    name = endpoint_name(url)
+    scheduler = _schedulers.get(name)
+    if scheduler is None:
+        settings = dict(Config.RATE_LIMITS.get("default", {}))
+        settings.update(Config.RATE_LIMITS.get(name, {}))
+        scheduler = _schedulers[name] = FairScheduler(name, settings["concurrency"])
+    return scheduler
+
+
+def scheduler_stats():
+    return {name: scheduler.stats() for name, scheduler in _schedulers.items()}
+
+
+registry.register(Gauge('scheduler_queued', 'Upstream calls waiting in the scheduler', ('endpoint',),
+                        lambda: {(name,): scheduler.queued for name, scheduler in _schedulers.items()}))
+registry.register(Gauge('scheduler_running', 'Upstream calls dispatched by the scheduler', ('endpoint',),
+                        lambda: {(name,): scheduler.running for name, scheduler in _schedulers.items()}))
+registry.register(CallbackCounter('scheduler_expired_total', 'Calls dropped after their deadline while queued',
+                                  ('endpoint',),
+                                  lambda: {(name,): scheduler.expired for name, scheduler in _schedulers.items()}))
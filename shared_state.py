@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config import Config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    rate REAL NOT NULL,
+    configured_rate REAL NOT NULL,
+    last_decrease_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS leases (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_leases_name ON leases (name);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    status TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """
+    多 worker 部署时进程间共享的状态：上游令牌桶、并发租约和后台任务快照。
+    保存在本地 SQLite 文件中，写操作都在 BEGIN IMMEDIATE 事务内完成，跨进程原子；
+    不依赖 fork 或共享内存，Windows 下同样可用。方法都是阻塞的，限流等热路径应在线程中调用
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # 每个 worker 进程一个标识，退出时据此释放自己持有的租约
+        self.worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # 写锁等待时间很短，拿不到时由调用方稍后重试，不长时间阻塞
+        self._conn = sqlite3.connect(path, timeout=Config.SHARED_BUSY_TIMEOUT, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction() as conn:
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+            # 异常退出的 worker 留下的租约到期后清理
+            conn.execute("DELETE FROM leases WHERE expires_at < ?", (time.time(),))
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def try_acquire(self, name: str, rate: float, burst: int, concurrency: int) -> Tuple[Optional[int], float]:
+        """
+        尝试取得一个令牌和一个并发名额，成功返回 (租约 ID, 0)，否则返回 (None, 建议等待秒数)。
+        配置的速率变化后重置令牌桶，自适应调整后的速率在各 worker 间共享
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated_at, rate, configured_rate FROM buckets WHERE name = ?",
+                               (name,)).fetchone()
+            if row is None or row[3] != rate:
+                tokens, updated_at, current_rate = float(burst), now, rate
+            else:
+                tokens, updated_at, current_rate = row[0], row[1], row[2]
+            tokens = min(burst, tokens + max(0.0, now - updated_at) * current_rate)
+            in_flight = conn.execute("SELECT COUNT(*) FROM leases WHERE name = ? AND expires_at >= ?",
+                                     (name, now)).fetchone()[0]
+            lease_id = None
+            wait = 0.0
+            if in_flight >= concurrency:
+                wait = Config.SHARED_POLL_INTERVAL
+            elif tokens < 1:
+                wait = (1 - tokens) / current_rate
+            else:
+                tokens -= 1
+                lease_id = conn.execute("INSERT INTO leases (name, worker, expires_at) VALUES (?, ?, ?)",
+                                        (name, self.worker, now + Config.SHARED_LEASE_TTL)).lastrowid
+            conn.execute(
+                "INSERT INTO buckets (name, tokens, updated_at, rate, configured_rate) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at, "
+                "rate = excluded.rate, configured_rate = excluded.configured_rate",
+                (name, tokens, now, current_rate, rate))
+        return lease_id, wait
+
+    def release(self, lease_id: int, name: str, outcomes: Sequence[bool] = (), min_rate: float = 0.0,
+                max_rate: float = 0.0, increase: float = 0.0, decrease: float = 1.0,
+                cooldown: float = 0.0) -> Optional[float]:
+        """
+        归还并发名额，并在同一事务中按 outcomes（每次调用是否过载）依次 AIMD 调整共享速率，
+        返回调整后的速率；规则与单进程限流器相同
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+            if not outcomes:
+                return None
+            row = conn.execute("SELECT rate, last_decrease_at FROM buckets WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            rate, last_decrease_at = row
+            for overloaded in outcomes:
+                if overloaded:
+                    # 冷却期内只降低一次，避免各 worker 的同一批失败请求把速率压到最低
+                    if now - last_decrease_at >= cooldown:
+                        rate = max(min_rate, rate * decrease)
+                        last_decrease_at = now
+                else:
+                    rate = min(max_rate, rate + increase / max(rate, 1.0))
+            conn.execute("UPDATE buckets SET rate = ?, last_decrease_at = ? WHERE name = ?",
+                         (rate, last_decrease_at, name))
+        return rate
+
+    def in_flight(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT name, COUNT(*) FROM leases WHERE expires_at >= ? GROUP BY name",
+                                      (time.time(),)).fetchall()
+        return dict(rows)
+
+    def save_job(self, job_id: str, status: str, snapshot: Dict[str, Any], created_at: float):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, worker, status, snapshot, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET status = excluded.status, snapshot = excluded.snapshot, "
+                "updated_at = excluded.updated_at",
+                (job_id, self.worker, status, json.dumps(snapshot, ensure_ascii=False, default=str), created_at,
+                 time.time()))
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT snapshot FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def jobs(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT snapshot FROM jobs ORDER BY created_at").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def request_cancel(self, job_id: str) -> bool:
+        with self._transaction() as conn:
+            return conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,)).rowcount > 0
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def prune_jobs(self, finished_statuses: List[str], keep: int):
+        # 与单进程一致，只保留最近 keep 个已结束的任务
+        placeholders = ', '.join('?' * len(finished_statuses))
+        with self._transaction() as conn:
+            conn.execute(
+                f"DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN ({placeholders}) "
+                f"ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (*finished_statuses, keep))
+
+    def close(self):
+        # 正常退出时释放本 worker 仍持有的租约
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE worker = ?", (self.worker,))
+        with self._lock:
+            self._conn.close()
+
+
+_shared_state: Optional[SharedState] = None
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """
+    单 worker 时返回 None，各模块使用进程内的状态
+    """
+    global _shared_state
+    if Config.WORKERS <= 1:
+        return None
+    if _shared_state is None:
+        _shared_state = SharedState(Config.SHARED_STATE_PATH)
+    return _shared_state
+
+
+def close_shared_state():
+    global _shared_state
+    if _shared_state is not None:
+        _shared_state.close()
+        _shared_state = None
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cache import cache_mode
+from config import Config
+from constant import CacheMode
+from logger import get_logger
+from metrics import Counter, Gauge, registry
+
+logger = get_logger(__name__)
+
+# NFKC 不处理的 CJK 部首补充区字符，PDF 转换的法规文本中常见（如 ⻋、⻔）
+RADICAL_MAP = str.maketrans({
+    '⺠': '民', '⺰': '纟', '⻅': '见', '⻆': '角', '⻈': '讠', '⻉': '贝',
+    '⻋': '车', '⻐': '钅', '⻓': '长', '⻔': '门', '⻘': '青', '⻙': '韦',
+    '⻚': '页', '⻛': '风', '⻜': '飞', '⻝': '食', '⻠': '饣', '⻢': '马',
+    '⻣': '骨', '⻤': '鬼', '⻥': '鱼', '⻦': '鸟', '⻧': '卤', '⻨': '麦',
+    '⻩': '黄', '⻪': '黾', '⻬': '齐', '⻮': '齿', '⻰': '龙', '⻳': '龟',
+})
+WHITESPACE = re.compile(r'\s+')
+# 数字、金额、期限、日期、款项序号等，条例只差这些时含义不同
+NUMBER = re.compile(r'\d+(?:\.\d+)?|[零〇一二三四五六七八九十百千万亿两]+')
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 61) - 1
+
+# 当前文件复用的条例，处理完成后随结果返回
+reuse_report: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("reuse_report", default=None)
+# 增量处理新增、修改的条例时关闭，内容变了的条例必须重新请求上游
+reuse_similar: ContextVar[bool] = ContextVar("reuse_similar", default=True)
+
+SIMILARITY_LOOKUPS = registry.register(Counter(
+    'similarity_lookups_total', 'Near-duplicate lookups by kind and outcome', ('kind', 'outcome')))
+
+
+def normalize_text(text: str) -> str:
+    """
+    NFKC 归一化（兼容部首、全角标点转为标准字符），替换部首补充区字符，合并空白
+    """
+    text = unicodedata.normalize('NFKC', str(text)).translate(RADICAL_MAP)
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def shingles(text: str) -> Set[str]:
+    # 中文没有分词，按字符 n-gram 切分；去掉空格避免排版差异影响相似度
+    text = text.replace(' ', '')
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def number_tokens(text: str) -> Tuple[str, ...]:
+    return tuple(NUMBER.findall(text))
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class MinHasher:
+    def __init__(self, num_perm: int, seed: int = 1):
+        # 参数固定种子生成，保证签名跨进程、跨运行一致，可以持久化
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+
+    def signature(self, items: Set[str]) -> List[int]:
+        hashes = [int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'big')
+                  for item in items]
+        return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+
+class SimilarityIndex:
+    """
+    已处理原子条例的近似重复索引：MinHash 签名按 band 分桶（LSH）找候选，
+    再用字符 n-gram 的 Jaccard 相似度确认，达到阈值且数字、日期等完全一致时复用已有结果。
+    条目持久化在 SQLite 中，启动时载入最新的 max_entries 条，超出上限时淘汰最早的条目
+    """
+
+    def __init__(self, path: str, threshold: float, num_perm: int, bands: int, max_entries: int):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(self.bands * self.rows)
+        # 字典顺序即加入索引的先后顺序，淘汰时从头开始
+        self.entries: Dict[int, Tuple[str, str, Set[str], Tuple[str, ...], Any]] = {}
+        self.texts: Dict[Tuple[str, str], int] = {}
+        self.buckets: Dict[Tuple[str, int, Tuple[int, ...]], List[int]] = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, text TEXT NOT NULL, "
+            "signature BLOB NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL, UNIQUE (kind, text))")
+        self._conn.commit()
+        # 签名随条目保存，启动时不需要重新计算；签名长度与当前配置不一致时重新计算
+        rows = self._conn.execute("SELECT id, kind, text, signature, result FROM entries ORDER BY id DESC LIMIT ?",
+                                  (max_entries,)).fetchall()
+        for entry_id, kind, text, signature, result in reversed(rows):
+            signature = array('Q', signature).tolist()
+            if len(signature) != len(self.hasher.permutations):
+                signature = self.hasher.signature(shingles(text))
+            self._index(entry_id, kind, text, signature, json.loads(result))
+
+    def _bands(self, signature: List[int]) -> List[Tuple[int, ...]]:
+        return [tuple(signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def _index(self, entry_id: int, kind: str, text: str, signature: List[int], result: Any):
+        self.entries[entry_id] = (kind, text, shingles(text), number_tokens(text), result)
+        self.texts[(kind, text)] = entry_id
+        for band, key in enumerate(self._bands(signature)):
+            self.buckets.setdefault((kind, band, key), []).append(entry_id)
+
+    def _evict(self):
+        # 淘汰最早加入的条目，同时从 SQLite 中删除
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            entry_id = next(iter(self.entries))
+            kind, text, items, _, _ = self.entries.pop(entry_id)
+            del self.texts[(kind, text)]
+            for band, key in enumerate(self._bands(self.hasher.signature(items))):
+                bucket = self.buckets.get((kind, band, key))
+                if bucket is not None and entry_id in bucket:
+                    bucket.remove(entry_id)
+                    if not bucket:
+                        del self.buckets[(kind, band, key)]
+            evicted.append((entry_id,))
+        if evicted:
+            self._conn.executemany("DELETE FROM entries WHERE id = ?", evicted)
+
+    def lookup(self, kind: str, text: str) -> Optional[Tuple[Any, float, str]]:
+        """
+        返回 (结果, 相似度, 匹配到的条例)，没有达到阈值的条目时返回 None
+        """
+        text = normalize_text(text)
+        with self._lock:
+            entry_id = self.texts.get((kind, text))
+            if entry_id is not None:
+                return self.entries[entry_id][4], 1.0, text
+            items = shingles(text)
+            numbers = number_tokens(text)
+            candidates = {candidate for band, key in enumerate(self._bands(self.hasher.signature(items)))
+                          for candidate in self.buckets.get((kind, band, key), ())}
+            best = None
+            for candidate in candidates:
+                _, candidate_text, candidate_items, candidate_numbers, result = self.entries[candidate]
+                # 期限、金额、序号等不同的条例即使文字几乎相同也不能复用
+                if candidate_numbers != numbers:
+                    continue
+                score = jaccard(items, candidate_items)
+                if score >= self.threshold and (best is None or score > best[1]):
+                    best = (result, score, candidate_text)
+        return best
+
+    def add(self, kind: str, text: str, result: Any):
+        text = normalize_text(text)
+        with self._lock:
+            if (kind, text) in self.texts:
+                return
+            signature = self.hasher.signature(shingles(text))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO entries (kind, text, signature, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, text, array('Q', signature).tobytes(), json.dumps(result, ensure_ascii=False), time.time()))
+            if cursor.rowcount:
+                entry_id = cursor.lastrowid
+            else:
+                # 其他 worker 已写入同一条例，lastrowid 不是这一行，改用已有的 id 和结果
+                entry_id, stored = self._conn.execute(
+                    "SELECT id, result FROM entries WHERE kind = ? AND text = ?", (kind, text)).fetchone()
+                result = json.loads(stored)
+            self._index(entry_id, kind, text, signature, result)
+            self._evict()
+            self._conn.commit()
+
+    def stats(self):
+        kinds: Dict[str, int] = {}
+        for kind, _, _, _, _ in self.entries.values():
+            kinds[kind] = kinds.get(kind, 0) + 1
+        return {"threshold": self.threshold, "entries": len(self.entries), "max_entries": self.max_entries,
+                "kinds": kinds}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_similarity_index: Optional[SimilarityIndex] = None
+
+
+def get_similarity_index() -> Optional[SimilarityIndex]:
+    global _similarity_index
+    if not Config.SIMILARITY_ENABLED:
+        return None
+    if _similarity_index is None:
+        _similarity_index = SimilarityIndex(Config.SIMILARITY_PATH, Config.SIMILARITY_THRESHOLD,
+                                            Config.SIMILARITY_NUM_PERM, Config.SIMILARITY_BANDS,
+                                            Config.SIMILARITY_MAX_ENTRIES)
+    return _similarity_index
+
+
+def close_similarity_index():
+    global _similarity_index
+    if _similarity_index is not None:
+        _similarity_index.close()
+        _similarity_index = None
+
+
+def find_similar(kind: str, text: str) -> Optional[Any]:
+    """
+    查找可复用的结果，与缓存一致：bypass、refresh 模式下不复用
+    """
+    index = get_similarity_index()
+    if index is None or not reuse_similar.get() or cache_mode.get() != CacheMode.USE:
+        return None
+    found = index.lookup(kind, text)
+    if found is None:
+        SIMILARITY_LOOKUPS.inc(kind=kind, outcome="miss")
+        return None
+    result, score, matched = found
+    if matched == text:
+        # 完全相同的条例属于普通重复，不计入复用报告
+        SIMILARITY_LOOKUPS.inc(kind=kind, outcome="exact")
+        return result
+    SIMILARITY_LOOKUPS.inc(kind=kind, outcome="normalized" if score == 1.0 else "similar")
+    logger.info("reused result of a similar rule", extra={"fields": {
+        "kind": kind, "score": round(score, 4), "rule": text, "matched": matched}})
+    report = reuse_report.get()
+    if report is not None:
+        report.append({"kind": kind, "rule": text, "matched": matched, "score": round(score, 4)})
+    return result
+
+
+def remember(kind: str, text: str, result: Any):
+    index = get_similarity_index()
+    if index is not None and cache_mode.get() != CacheMode.BYPASS:
+        index.add(kind, text, result)
+
+
+registry.register(Gauge('similarity_index_entries', 'Atom rules in the near-duplicate index', (),
+                        lambda: {(): len(_similarity_index.entries)} if _similarity_index else {}))
@@ -0,0 +1,113 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from config import Config
+from constant import SpeculationMode
+from metrics import CallbackCounter, Gauge, registry
+
+
+class SpeculationPolicy:
+    """
+    一对有依赖的上游调用（先判断，再按结果决定是否调用第二个接口）的投机策略。
+    以 EWMA 统计第二个调用实际需要的比例（命中率），auto 模式下命中率达到阈值才同时发起两个调用
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hit_rate = 0.0
+        self.observations = 0
+        self.speculated = 0
+        self.hits = 0
+        self.wasted = 0
+        self.sequential = 0
+
+    def should_speculate(self) -> bool:
+        mode = SpeculationMode(Config.SPECULATION_MODE)
+        if mode == SpeculationMode.ON:
+            return True
+        if mode == SpeculationMode.AUTO:
+            # 样本不足时按顺序调用，先观察命中率
+            return (self.observations >= Config.SPECULATION_WARMUP
+                    and self.hit_rate >= Config.SPECULATION_MIN_HIT_RATE)
+        return False
+
+    def record(self, speculated: bool, needed: bool):
+        # 顺序调用时同样能观察到是否需要第二个调用，关闭投机期间命中率也保持更新
+        alpha = Config.SPECULATION_EWMA_ALPHA
+        self.hit_rate = float(needed) if self.observations == 0 else \
+            (1 - alpha) * self.hit_rate + alpha * float(needed)
+        self.observations += 1
+        if not speculated:
+            self.sequential += 1
+        elif needed:
+            self.speculated += 1
+            self.hits += 1
+        else:
+            self.speculated += 1
+            self.wasted += 1
+
+    def stats(self):
+        return {
+            "hit_rate": round(self.hit_rate, 4),
+            "observations": self.observations,
+            "speculating": self.should_speculate(),
+            "speculated": self.speculated,
+            "sequential": self.sequential,
+            "wasted": self.wasted,
+            # 投机发出但结果被丢弃的调用占投机调用的比例
+            "wasted_call_ratio": round(self.wasted / self.speculated, 4) if self.speculated else 0.0,
+        }
+
+
+_policies: Dict[str, SpeculationPolicy] = {}
+
+
+def get_policy(name: str) -> SpeculationPolicy:
+    policy = _policies.get(name)
+    if policy is None:
+        policy = _policies[name] = SpeculationPolicy(name)
+    return policy
+
+
+async def run_dependent(name: str, first: Callable[[], Awaitable[Any]], second: Callable[[], Awaitable[Any]],
+                        needed: Callable[[Any], bool]) -> Tuple[Any, Optional[Any]]:
+    """
+    执行 first，needed(first 的结果) 为真时再执行 second，返回 (first 结果, second 结果或 None)。
+    投机时两个调用同时发起，不需要的 second 结果直接丢弃；
+    上游调用经过 single-flight 独立执行，丢弃的调用仍会完成并写入缓存
+    """
+    policy = get_policy(name)
+    if not policy.should_speculate():
+        first_result = await first()
+        is_needed = needed(first_result)
+        policy.record(False, is_needed)
+        return first_result, (await second() if is_needed else None)
+
+    second_task = asyncio.ensure_future(second())
+    try:
+        first_result = await first()
+        is_needed = needed(first_result)
+    except BaseException:
+        second_task.cancel()
+        raise
+    policy.record(True, is_needed)
+    if not is_needed:
+        second_task.cancel()
+        return first_result, None
+    return first_result, await second_task
+
+
+def speculation_stats():
+    return {name: policy.stats() for name, policy in _policies.items()}
+
+
+def _policy_values(field: str):
+    return lambda: {(name,): getattr(policy, field) for name, policy in _policies.items()}
+
+
+registry.register(Gauge('speculation_hit_rate', 'EWMA share of dependent calls that were needed', ('pair',),
+                        _policy_values('hit_rate')))
+registry.register(CallbackCounter('speculation_hits_total', 'Speculative calls whose result was used', ('pair',),
+                                  _policy_values('hits')))
+registry.register(CallbackCounter('speculation_wasted_total', 'Speculative calls whose result was discarded',
+                                  ('pair',), _policy_values('wasted')))
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import api
+import main
+import similarity
+from config import Config
+from constant import RuleChange
+from model import RuleObject
+
+OLD_RULE = "网约车驾驶员应当取得本市核发的驾驶证，并具有三年以上驾驶经历"
+# 只改了标点，归一化后与旧条例相同，近似复用会直接沿用旧的分类
+NEW_RULE = "网约车驾驶员应当取得本市核发的驾驶证,并具有三年以上驾驶经历"
+UNCHANGED_RULE = "平台公司应当向监管部门实时报送相关数据"
+
+
+def fake_upstream(calls):
+    async def api_request(url, data):
+        calls.append((url, data.get("rule")))
+        if url == Config.CHECK_ATOM_RULE_URL:
+            return {"data": 1}
+        if url == Config.IDENTIFY_RULES_URL:
+            return {"data": 1}
+        if url == Config.CLASSIFY_RULES_URL:
+            return {"category": "新分类", "type": "新类型"}
+        if url == Config.EXTRACT_COMMON_RULES_URL:
+            return {"subject": "驾驶员"}
+        if url == Config.GENERATE_CDSRL_URL:
+            return {"cdsrl": "new"}
+        return {"error": f"unexpected url {url}"}
+    return api_request
+
+
+def previous_rules():
+    old_row = ["1", "旧分类", "旧类型", json.dumps({"subject": "旧"}), json.dumps({"cdsrl": "old"})]
+    unchanged_row = ["1", "内容监管", "许可", json.dumps({"subject": "平台"}), json.dumps({"cdsrl": "kept"})]
+    return [
+        (RuleObject(rule_order="第1条", rule_content=OLD_RULE, atom="1", atom_rules=[OLD_RULE]), [old_row]),
+        (RuleObject(rule_order="第2条", rule_content=UNCHANGED_RULE, atom="1", atom_rules=[UNCHANGED_RULE]),
+         [unchanged_row]),
+    ]
+
+
+def run_changed_clause(tmp_path, monkeypatch, fused):
+    monkeypatch.setattr(Config, "SIMILARITY_ENABLED", True)
+    monkeypatch.setattr(Config, "SIMILARITY_PATH", str(tmp_path / "similarity.sqlite3"))
+    calls = []
+    monkeypatch.setattr(api, "api_request", fake_upstream(calls))
+    # 旧条例的分类已在近似索引中
+    similarity.remember('classify', OLD_RULE, {"supervise": "1", "supervise_category": "旧分类",
+                                               "supervise_type": "旧类型"})
+    rule_list = [{"rule_order": "第1条", "rule_content": NEW_RULE},
+                 {"rule_order": "第2条", "rule_content": UNCHANGED_RULE}]
+    try:
+        _, rows, changes = asyncio.run(main.run_incremental("revised.docx", rule_list, str(tmp_path / "out"),
+                                                            previous_rules(), fused))
+    finally:
+        similarity.close_similarity_index()
+    return calls, rows, changes
+
+
+def test_changed_clause_is_regenerated(tmp_path, monkeypatch):
+    calls, rows, changes = run_changed_clause(tmp_path, monkeypatch, fused=False)
+
+    assert changes[RuleChange.CHANGED.value] == ["第1条"]
+    assert changes["processed"] == 1
+    assert (Config.CLASSIFY_RULES_URL, NEW_RULE) in calls
+    # 未变化的条例不请求上游
+    assert all(rule != UNCHANGED_RULE for _, rule in calls)
+    assert rows[0][:3] == ["1", "新分类", "新类型"]
+    assert rows[1][1] == "内容监管"
+
+
+def test_changed_clause_is_regenerated_fused(tmp_path, monkeypatch):
+    calls, rows, _ = run_changed_clause(tmp_path, monkeypatch, fused=True)
+
+    assert (Config.CLASSIFY_RULES_URL, NEW_RULE) in calls
+    assert (Config.GENERATE_CDSRL_URL, NEW_RULE) in calls
+    assert rows[0][1] == "新分类"
+    assert json.loads(rows[0][4]) == {"cdsrl": "new"}
+    assert json.loads(rows[1][4]) == {"cdsrl": "kept"}
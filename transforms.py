@@ -0,0 +1,313 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+from openpyxl.reader.excel import load_workbook
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.worksheet import Worksheet
+
+from api import extract_common_element, gather_with_concurrency, generate_cdsrl
+from config import Config
+from constant import PostProcessStep
+from cpu_pool import run_cpu
+from excel_reader import AUTOMATABLE_COLUMN, is_auto_supervised
+from jobs import add_rules, advance_rules, current_file
+from journal import current_journal, file_hash, file_journal, journal_get, journal_put, journal_resume
+from logger import current_rule, get_logger
+from metrics import WORKBOOK_DURATION
+from results_store import get_results_store
+
+logger = get_logger(__name__)
+
+
+class WorkbookTransform:
+    """
+    工作簿变换步骤：prepare 在事件循环中执行网络请求等异步工作，
+    apply 是纯同步的工作表修改，和加载、保存一起在进程池中执行，多个步骤只加载、保存一次
+    """
+    step: PostProcessStep
+    # prepare 中上游失败、写入了 {"error": ...} 的行数，有失败时文件不记为已完成，下次重新处理
+    failed = 0
+
+    def describe(self) -> str:
+        return self.step.value
+
+    async def prepare(self, file_path: str):
+        pass
+
+    def apply(self, sheet: Worksheet):
+        raise NotImplementedError
+
+
+def is_enriched(value: Any) -> bool:
+    """
+    单元格中已有成功生成的结果：非空，且不是出错时写入的 {"error": ...}
+    """
+    if not value:
+        return False
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return True
+    return not (isinstance(parsed, dict) and 'error' in parsed)
+
+
+def read_enrich_rows(file_path: str, skip_enriched: bool = False) -> List[Tuple[int, str, str]]:
+    """
+    只读模式读取可自动监管的原子条例，返回 (数据行号, atom_rule_content, category)，行号从 0 开始；
+    skip_enriched 时跳过 common_element、CDSRL_result 两列都已有结果的行
+    """
+    workbook = load_workbook(file_path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        content_col = header.index('atom_rule_content')
+        category_col = header.index('category')
+        auto_col = header.index(AUTOMATABLE_COLUMN)
+        enriched_cols = [header.index(name) for name in ('common_element', 'CDSRL_result') if name in header]
+        if not skip_enriched or len(enriched_cols) < 2:
+            enriched_cols = []
+        return [(row_index, row[content_col], row[category_col]) for row_index, row in enumerate(rows)
+                if is_auto_supervised(row[auto_col])
+                and not (enriched_cols and all(is_enriched(row[col]) for col in enriched_cols))]
+    finally:
+        workbook.close()
+
+
+async def enrich_rule(content: str, category: str, journal_key: Tuple) -> Tuple[str, str]:
+    """
+    提取通用要素并生成 CDSRL，返回两列要写入的 JSON 字符串；journal_key 为断点续跑日志中的记录键
+    """
+    # 断点续跑：复用上次已完成的结果
+    journaled = journal_get(*journal_key)
+    if journaled is not None:
+        return journaled['common_element'], journaled['CDSRL_result']
+    try:
+        entity_info = await extract_common_element(content, category)
+        logger.debug("common element extracted", extra={"fields": {"entity_info": entity_info}})
+        common_element = json.dumps(entity_info, ensure_ascii=False)
+
+        cdsrl_result = await generate_cdsrl(content, category, entity_info)
+        logger.debug("CDSRL generated", extra={"fields": {"cdsrl_result": cdsrl_result}})
+        cdsrl = json.dumps(cdsrl_result, ensure_ascii=False)
+
+        if 'error' not in entity_info and 'error' not in cdsrl_result:
+            journal_put({"common_element": common_element, "CDSRL_result": cdsrl}, *journal_key)
+    except Exception as e:
+        logger.error("failed to enrich rule", extra={"fields": {"error": str(e)}})
+        # 可以选择在这里设置一个错误值
+        common_element = json.dumps({"error": str(e)}, ensure_ascii=False)
+        cdsrl = json.dumps({"error": str(e)}, ensure_ascii=False)
+    return common_element, cdsrl
+
+
+async def process_row(row_index: int, content: str, category: str) -> Tuple[str, str]:
+    current_rule.set(f"row:{row_index}")
+    result = await enrich_rule(content, category, ('enrich', row_index, content, category))
+    advance_rules(stage="enrich", row=row_index)
+    return result
+
+
+class EnrichTransform(WorkbookTransform):
+    """
+    为可自动监管的原子条例提取通用要素并生成 CDSRL
+    """
+    step = PostProcessStep.MODIFY
+
+    def __init__(self, skip_enriched: bool = False):
+        # 增量模式下已有结果的行保持不变
+        self.skip_enriched = skip_enriched
+        # 数据行号 -> (common_element, CDSRL_result)，prepare 中填充，apply 时写回
+        self.updates: Dict[int, Tuple[str, str]] = {}
+
+    async def prepare(self, file_path: str):
+        rows = await run_cpu(read_enrich_rows, file_path, self.skip_enriched)
+
+        # 同时处理的条例数有上限，大表不会一次创建上万个等待中的请求
+        add_rules(len(rows))
+        results = await gather_with_concurrency(
+            Config.RULE_CONCURRENCY,
+            [process_row(row_index, content, category) for row_index, content, category in rows], stage="enrich")
+        self.updates = {row_index: result for (row_index, _, _), result in zip(rows, results)}
+        self.failed = sum(1 for values in self.updates.values() if not all(map(is_enriched, values)))
+
+    def apply(self, sheet: Worksheet):
+        # 只改 common_element、CDSRL_result 两列，列不存在时追加在最后
+        headers = [cell.value for cell in sheet[1]]
+        columns = []
+        for name in ('common_element', 'CDSRL_result'):
+            if name not in headers:
+                headers.append(name)
+                sheet.cell(row=1, column=len(headers), value=name)
+            columns.append(headers.index(name) + 1)
+
+        # 只写入内容有变化的单元格，第 1 行是列名
+        for row_index, values in self.updates.items():
+            for column, value in zip(columns, values):
+                cell = sheet.cell(row=row_index + 2, column=column)
+                if cell.value != value:
+                    cell.value = value
+
+
+class BeautifyTransform(WorkbookTransform):
+    """
+    调整 common_element 和 CDSRL_result 两列的宽度并换行显示
+    """
+    step = PostProcessStep.BEAUTIFY
+
+    def apply(self, sheet: Worksheet):
+        # 检查是否已存在这两列，如果不存在则添加
+        headers = [cell.value for cell in sheet[1]]
+        if 'common_element' not in headers:
+            sheet.cell(row=1, column=sheet.max_column - 1, value='common_element')
+        if 'CDSRL_result' not in headers:
+            sheet.cell(row=1, column=sheet.max_column, value='CDSRL_result')
+
+        # 获取这两列的列号
+        common_element_col = None
+        cdsrl_result_col = None
+        for cell in sheet[1]:
+            if cell.value == 'common_element':
+                common_element_col = cell.column
+            elif cell.value == 'CDSRL_result':
+                cdsrl_result_col = cell.column
+
+        if common_element_col and cdsrl_result_col:
+            alignment = Alignment(vertical='bottom', wrap_text=True)
+            for col in [common_element_col, cdsrl_result_col]:
+                letter = get_column_letter(col)
+                max_length = 0
+                for cell in sheet[letter]:
+                    if len(str(cell.value)) > max_length:
+                        max_length = len(str(cell.value))
+                adjusted_width = (max_length + 2) * 1.2
+                sheet.column_dimensions[letter].width = adjusted_width
+
+                for cell in sheet[letter]:
+                    cell.alignment = alignment
+
+
+class ColumnWidthTransform(WorkbookTransform):
+    """
+    设置最后两列的宽度
+    """
+    step = PostProcessStep.COLUMN_WIDTH
+
+    def __init__(self, width: float = 15):
+        self.width = width
+
+    def describe(self) -> str:
+        return f"{self.step.value}={self.width}"
+
+    def apply(self, sheet: Worksheet):
+        # 获取最后两列的列号
+        last_column = sheet.max_column
+        second_last_column = last_column - 1
+
+        # 设置最后两列的宽度
+        for col in [second_last_column, last_column]:
+            column_letter = get_column_letter(col)
+            sheet.column_dimensions[column_letter].width = self.width
+
+
+def build_transforms(steps: List[PostProcessStep], width: float = 30) -> List[WorkbookTransform]:
+    """
+    按固定顺序（补充 CDSRL、美化、设置列宽）组装所选步骤
+    """
+    transforms = [EnrichTransform(), BeautifyTransform(), ColumnWidthTransform(width)]
+    return [transform for transform in transforms if transform.step in steps]
+
+
+async def apply_transforms(file_path: str, transforms: List[WorkbookTransform]):
+    """
+    加载一次工作簿，在内存中依次执行所有步骤，最后只保存一次
+    """
+    if not os.path.exists(file_path):
+        return {"file": file_path, "status": "Failed", "error": "File does not exist"}
+
+    # 只有包含补充 CDSRL 步骤时才需要断点续跑，其余步骤开销很小
+    journal = current_journal.get()
+    if not any(isinstance(transform, EnrichTransform) for transform in transforms):
+        journal = None
+    phase = '+'.join(transform.describe() for transform in transforms)
+    if journal is not None and journal_resume.get() and journal.is_file_done(phase, file_path, file_hash(file_path)):
+        return {"file": file_path, "status": "Skipped", "reason": "Up to date"}
+
+    token = file_journal.set(journal.for_file(phase, file_path, journal_resume.get())) if journal else None
+    # 后台任务中已由 JobManager 设置当前文件
+    file_token = current_file.set(file_path) if current_file.get() is None else None
+    try:
+        result = await _apply_transforms(file_path, transforms)
+    finally:
+        if token is not None:
+            file_journal.reset(token)
+        if file_token is not None:
+            current_file.reset(file_token)
+    if result["status"] not in ("Modified", "Skipped"):
+        logger.error("failed to transform workbook", extra={"fields": {"phase": phase, **result}})
+    if result["status"] == "Modified":
+        failed = sum(transform.failed for transform in transforms)
+        if failed:
+            # 部分行失败时不记为已完成，上游恢复后重新运行只重试失败的行
+            result["failed_rows"] = failed
+        elif journal is not None:
+            journal.file_done(phase, file_path, file_hash(file_path))
+        # 补充的 CDSRL 同步写入结果库
+        store = get_results_store()
+        for transform in transforms:
+            if isinstance(transform, EnrichTransform) and store is not None:
+                store.update_enrichment(file_path, transform.updates)
+    return result
+
+
+async def _apply_transforms(file_path: str, transforms: List[WorkbookTransform]):
+    for transform in transforms:
+        try:
+            await transform.prepare(file_path)
+        except Exception as e:
+            return {"file": file_path, "status": "Failed to process", "step": transform.step.value, "error": str(e)}
+
+    result = await run_cpu(transform_workbook, file_path, transforms)
+    # 进程池中的耗时由结果带回，在主进程中记录
+    for operation, seconds in result.pop("timings", {}).items():
+        WORKBOOK_DURATION.observe(seconds, operation=operation)
+    return result
+
+
+def transform_workbook(file_path: str, transforms: List[WorkbookTransform]):
+    """
+    在进程池中执行：加载工作簿，依次执行各步骤的 apply，最后保存一次。
+    读取阶段（read_enrich_rows、统计）是只读流式的，内存与行数无关；写回仍完整加载工作簿，
+    因为只读模式读不到合并单元格和单元格样式，流式重写会丢失原有格式，峰值内存随工作簿大小增长
+    """
+    timings = {}
+    try:
+        os.chmod(file_path, 0o666)
+        # 读取Excel文件，保留原有格式
+        start = time.perf_counter()
+        workbook = load_workbook(file_path)
+        timings["load"] = time.perf_counter() - start
+        sheet = workbook.active
+    except PermissionError:
+        return {"file": file_path, "status": "Failed to read",
+                "error": "Permission denied. The file might be open in another program."}
+    except Exception as e:
+        return {"file": file_path, "status": "Failed to read", "error": str(e)}
+
+    for transform in transforms:
+        try:
+            transform.apply(sheet)
+        except Exception as e:
+            return {"file": file_path, "status": "Failed to process", "step": transform.step.value, "error": str(e),
+                    "timings": timings}
+
+    try:
+        start = time.perf_counter()
+        workbook.save(file_path)
+        timings["save"] = time.perf_counter() - start
+        return {"file": file_path, "status": "Modified", "steps": [transform.step.value for transform in transforms],
+                "timings": timings}
+    except Exception as e:
+        return {"file": file_path, "status": "Failed to save", "error": str(e), "timings": timings}